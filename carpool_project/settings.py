@@ -44,6 +44,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "trips.instrumentation.InstrumentationMiddleware",  # Only with TRIPS_INSTRUMENTATION
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -85,6 +86,9 @@ DATABASES = {
         default=config('DATABASE_URL')
     )
 }
+# By default SQLite tests run in memory, where the concurrency tests are skipped: its table locks
+# fail at once (see trips.tests.ConcurrentRegistrationTest). Set it to a file to run them.
+DATABASES['default']['TEST'] = {'NAME': config('TEST_DATABASE_NAME', default=None)}
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
@@ -122,3 +126,32 @@ STATIC_URL = '/static/'
 
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 LOGIN_URL = '/admin/login/'
+
+# Per request DB and Python timings, as Server-Timing headers and logs (trips.instrumentation)
+TRIPS_INSTRUMENTATION = config('TRIPS_INSTRUMENTATION', default=False, cast=bool)
+
+# Trips reports: above this many people, the "minimal" strategy falls back to the heap one
+TRIPS_MINIMAL_TRANSFERS_MAX_PARTICIPANTS = config(
+    'TRIPS_MINIMAL_TRANSFERS_MAX_PARTICIPANTS', default=14, cast=int
+)
+
+# Suggested price per trip: bus fares of the route, cached by `manage.py refresh_fares`
+# (trips.fares) in a cache shared by every process. The URL gets the route and the date.
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'fares': {  # Its table is made by `manage.py createcachetable`
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'trips_fare_cache',
+    },
+}
+TRIPS_FARE_CACHE = 'fares'
+TRIPS_FARE_URL = config(
+    'TRIPS_FARE_URL',
+    default='https://compraonline.sittnet.net/ar/6338/Resultados.aspx'
+            '?param={route}/{date:%d-%m-%Y}/0/{date:%d-%m-%Y}',
+)
+TRIPS_FARE_ROUTE = config('TRIPS_FARE_ROUTE', default='395/758')
+
+# Where the payments of the new reports are computed (trips.background): "thread", a thread
+# pool of the web process, or "" for just `manage.py process_reports` workers
+TRIPS_REPORTS_EXECUTOR = config('TRIPS_REPORTS_EXECUTOR', default='thread')
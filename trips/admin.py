@@ -1,11 +1,19 @@
 from django.contrib.auth.models import Group, User
 from django.contrib.auth.admin import GroupAdmin, UserAdmin
+from datetime import date, timedelta
+
 from django.contrib import admin
 from django.contrib.admin import AdminSite
+from django.contrib.admin.views.main import ChangeList
+from django.db.models import Aggregate, CharField, DateField, Max, Min, OuterRef, Q, Subquery
 from django.urls import reverse
 from django.utils.html import format_html
 
-from trips.models import Car, Trip, Report
+from trips import background, fares
+from trips.instrumentation import stage
+from trips.models import (
+    SCHEDULE_DAYS_AHEAD, Car, Schedule, Trip, Report, carpool_groups, group_filter, stale_claims
+)
 
 
 class TripsAdminSite(AdminSite):
@@ -17,12 +25,62 @@ class TripsAdminSite(AdminSite):
 admin_site = TripsAdminSite(name="myadmin")
 
 
-class CarAdmin(admin.ModelAdmin):
-    list_display = ("owner", "description", "price_per_trip")
+class CarpoolGroupAdmin(admin.ModelAdmin):
+    """Only the objects of the carpool groups of the user (see group_filter()), and their cars.
+
+    `group_lookup` is the model's lookup of its group.
+    """
+    group_lookup = "group"
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).filter(
+            group_filter(request.user, self.group_lookup)
+        )
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == "car":
+            kwargs["queryset"] = Car.objects.filter(group_filter(request.user))
+        elif db_field.name == "group":
+            groups = carpool_groups(request.user)
+            if groups is not None:
+                kwargs["queryset"] = Group.objects.filter(pk__in=groups)
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+
+class CarAdmin(CarpoolGroupAdmin):
+    list_display = ("owner", "description", "price_per_trip", "group")
+    list_select_related = ("owner", "group")
+    readonly_fields = ("suggested_price",)
+
+    def suggested_price(self, obj):
+        """From the cached bus fares (see trips.fares), never fetched while rendering."""
+        price = fares.suggested_price()
+        return "Sin precios todavía (manage.py refresh_fares)" if price is None else price
+    suggested_price.short_description = "Precio sugerido"
 
 
 admin_site.register(Car, CarAdmin)
 
+
+class ScheduleAdmin(CarpoolGroupAdmin):
+    group_lookup = "car__group"
+    list_display = ("car", "way", "weekdays", "since", "until")
+    list_filter = (("car", admin.RelatedOnlyFieldListFilter), "way")
+    filter_horizontal = ("passengers",)
+    actions = ("materialize_next_weeks",)
+
+    def materialize_next_weeks(self, request, queryset):
+        today = date.today()
+        created = queryset.materialize(today, today + timedelta(days=SCHEDULE_DAYS_AHEAD - 1))
+        self.message_user(request, f"{created} trips created.")
+
+    materialize_next_weeks.short_description = (
+        f"Create the trips of the next {SCHEDULE_DAYS_AHEAD} days"
+    )
+
+
+admin_site.register(Schedule, ScheduleAdmin)
+
 # def create_report(request, queryset):
 #     report = 4
 #     v = createReportView()
@@ -40,12 +98,63 @@ class TripInline(admin.TabularInline):
     can_delete = False
     show_change_link = True
 
-class ReportAdmin(admin.ModelAdmin):
+
+class GroupConcat(Aggregate):
+    """The values (e.g. IDs) joined with commas, in no particular order."""
+    function = "GROUP_CONCAT"
+    allow_distinct = True
+    output_field = CharField()
+
+    def as_postgresql(self, compiler, connection):
+        return super().as_sql(compiler, connection, function="STRING_AGG",
+                              template="%(function)s(%(distinct)s(%(expressions)s)::text, ',')")
+
+
+def per_report(queryset, report_field, aggregate, output_field):
+    """Subquery of the aggregate of the queryset rows of each report (of the outer query)."""
+    return Subquery(queryset.filter(**{report_field: OuterRef("pk")}).order_by().values(
+        report_field
+    ).annotate(value=aggregate).values("value"), output_field=output_field)
+
+
+class ReportChangeList(ChangeList):
+    """Resolves the people of the reports of the page to their names, with a single in_bulk()."""
+
+    def get_results(self, request):
+        super().get_results(request)
+        reports = list(self.result_list)  # Evaluated (and cached) once, for the whole page
+        people = {
+            report.pk: {int(uid) for uid in f"{report.passenger_ids},{report.driver_ids}".split(",")
+                        if uid.isdigit()}
+            for report in reports
+        }
+        names = User.objects.only("first_name").in_bulk(set().union(*people.values()))
+        for report in reports:
+            report.people_names = sorted(
+                {names[uid].first_name for uid in people[report.pk]} - {""}
+            )
+
+
+class ReportAdmin(CarpoolGroupAdmin):
     list_display = (
-        "creator", "created_time", "report_trips_since", "report_trips_until", "people_involved",
-        "payments"
+        "creator", "created_time", "group", "report_trips_since", "report_trips_until",
+        "people_involved", "status", "payments"
     )
+    list_filter = ("status",)
     inlines = [TripInline, ]
+    actions = ("retry_reports",)
+
+    def retry_reports(self, request, queryset):
+        retried = Q(status=Report.FAILED) | stale_claims()
+        reports = list(queryset.filter(retried))
+        Report.objects.filter(retried, pk__in=[r.pk for r in reports]).update(
+            status=Report.PENDING
+        )
+        for report in reports:
+            background.enqueue(report)
+        self.message_user(request, f"{len(reports)} reports will be computed again.")
+
+    retry_reports.short_description = "Compute the payments of the failed (or stuck) reports again"
 
     def payments(self, obj):
         url = reverse("trips:report_payments", args=(obj.id,))
@@ -53,21 +162,34 @@ class ReportAdmin(admin.ModelAdmin):
     payments.allow_tags = True
     payments.short_description = "Payments details"
 
+    def get_queryset(self, request):
+        # The trips dates and people (IDs, see ReportChangeList) of every report, aggregated by the
+        # reports query
+        passengers = Trip.passengers.through.objects
+        return super().get_queryset(request).select_related(
+            "creator", "group"
+        ).defer("snapshot").annotate(
+            trips_since=per_report(Trip.objects, "report", Min("date"), DateField()),
+            trips_until=per_report(Trip.objects, "report", Max("date"), DateField()),
+            passenger_ids=per_report(passengers, "trip__report",
+                                     GroupConcat("user", distinct=True), CharField()),
+            driver_ids=per_report(Trip.objects, "report",
+                                  GroupConcat("car__owner", distinct=True), CharField()),
+        )
+
+    def get_changelist(self, request, **kwargs):
+        return ReportChangeList
+
     def report_trips_since(self, obj):
-        if obj.trips.exists():
-            return obj.trips.order_by("date").first().date
+        return obj.trips_since
+    report_trips_since.admin_order_field = "trips_since"
 
     def report_trips_until(self, obj):
-        if obj.trips.exists():
-            return obj.trips.order_by("date").last().date
+        return obj.trips_until
+    report_trips_until.admin_order_field = "trips_until"
 
     def people_involved(self, obj):
-        people = set()
-        if obj.trips.exists():
-            passengers = User.objects.filter(trips__in=obj.trips.all()).distinct()
-            drivers = {t.car.owner for t in obj.trips.all().distinct()}
-            people = drivers.union(passengers)
-        return [p.first_name for p in people]
+        return ", ".join(obj.people_names)
 
 
 admin_site.register(Report, ReportAdmin)
@@ -108,16 +230,23 @@ class FilterTripsIfTheyHaveAReport(admin.SimpleListFilter):
         if self.value() is not None:
             return queryset.filter(report__isnull=(self.value()=="no"))
 
-class TripAdmin(admin.ModelAdmin):
+class TripAdmin(CarpoolGroupAdmin):
+    group_lookup = "car__group"
     date_hierarchy = "date"
     readonly_fields = ("price_per_passenger",)
     list_display = (
         "date", "way", "car", "price_per_passenger", "people_names", "included_in_report", "notes"
     )
-    list_filter = ("car", "way", FilterTripsIfTheyHaveAReport)
+    list_filter = (("car", admin.RelatedOnlyFieldListFilter), "way", FilterTripsIfTheyHaveAReport)
     ordering = ("-date", "way")
     actions = ("create_report", )
 
+    def get_queryset(self, request):
+        # Everything people_names, included_in_report and str(car) need, in a constant # of queries
+        return super().get_queryset(request).select_related(
+            "car__owner", "report__creator"
+        ).prefetch_related("passengers")
+
     def included_in_report(self, obj):
         if obj.report is not None:
             return format_html(f"<a href='{obj.report.get_absolute_url()}''>{obj.report}</a>")
@@ -126,6 +255,10 @@ class TripAdmin(admin.ModelAdmin):
     included_in_report.allow_tags = True
 
     def create_report(self, request, queryset):
+        with stage("create_report"):
+            return self._create_report(request, queryset)
+
+    def _create_report(self, request, queryset):
         already_on_report = queryset.filter(report__isnull=False)
         if already_on_report.exists():
             self.message_user(
@@ -134,8 +267,12 @@ class TripAdmin(admin.ModelAdmin):
                 level=messages.WARNING)
             return
 
-        report = Report.objects.create(creator=request.user)
-        queryset.update(report=report)
+        try:
+            report = queryset.create_report(request.user)
+        except ValueError as e:  # Trips of several groups
+            self.message_user(request, str(e), level=messages.WARNING)
+            return
+        background.enqueue(report)  # The report page waits for the payments
         self.message_user(request, "New report created: %s" % str(report))
         return HttpResponseRedirect(reverse("trips:report_payments", args=(report.id,)))
 
@@ -0,0 +1,51 @@
+"""The payments of the new reports, computed off the request (see Report.status).
+
+The reports table is the queue: `manage.py process_reports` computes the pending ones. With
+the TRIPS_REPORTS_EXECUTOR setting set to "thread", each new report is also handed, once
+committed, to a thread pool of the web process itself, so no worker is needed.
+
+A restart loses the reports queued on the threads, or being computed there (and a killed worker
+the one it was computing). The command picks up the pending ones, and claims again the running
+ones after REPORT_CLAIM_TIMEOUT (see ReportQuerySet.claim()). Without the command, they can be
+retried from the admin, like the failed ones.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from trips.models import Report
+
+
+logger = logging.getLogger(__name__)
+
+REPORTS_THREADS = 2
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, "TRIPS_REPORTS_THREADS", REPORTS_THREADS),
+            thread_name_prefix="reports",
+        )
+    return _executor
+
+
+def process_report(report_id):
+    """Compute the report, if it's still pending, on its own DB connection."""
+    try:
+        Report.objects.filter(pk=report_id).process()
+    except Exception:
+        logger.exception("Couldn't process report %s", report_id)
+    finally:
+        connection.close()  # The connection of this executor thread
+
+
+def enqueue(report):
+    """Compute the payments of the (pending) report in the background, once committed."""
+    if getattr(settings, "TRIPS_REPORTS_EXECUTOR", None) == "thread":
+        transaction.on_commit(lambda: get_executor().submit(process_report, report.pk))
@@ -0,0 +1,126 @@
+"""Exports of a report (its details, per user totals and transfers) as CSV or JSON, streamed.
+
+The rows are generated from a server-side cursor (QuerySet.iterator()), so the memory used
+doesn't depend on how many trips the report covers: just the per user totals are kept.
+"""
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from trips.payments import (
+    DEFAULT_SETTLEMENT, SETTLEMENT_STRATEGIES, from_cents, full_name, split_balances, to_cents
+)
+
+
+EXPORT_CHUNK_SIZE = 2000  # Rows fetched from the cursor at a time
+
+# Columns of the report trips, one row per (trip, passenger)
+DETAIL_FIELDS = (
+    "date", "way", "price_per_passenger",
+    "car__owner", "car__owner__username", "car__owner__first_name", "car__owner__last_name",
+    "passengers", "passengers__username", "passengers__first_name", "passengers__last_name",
+)
+
+DETAILS_HEADER = ("date", "way", "passenger", "passenger_name", "driver", "driver_name", "price")
+TOTALS_HEADER = ("username", "name", "collects", "pays", "balance")
+TRANSFERS_HEADER = ("payer", "payer_name", "collector", "collector_name", "ammount")
+
+
+def edges(report, chunk_size=EXPORT_CHUNK_SIZE):
+    """Every (trip, passenger) of the report, but the drivers in their own cars, by date.
+
+    Yields (date, way, price, (driver ID, username, full name), (passenger ID, username, name)).
+    """
+    rows = report.trips.order_by("date", "way", "pk").values_list(*DETAIL_FIELDS)
+    for (date, way, price, owner_id, owner_username, owner_first, owner_last,
+         passenger_id, username, first_name, last_name) in rows.iterator(chunk_size=chunk_size):
+        if passenger_id is None or passenger_id == owner_id:
+            continue
+        yield (
+            date, way, price,
+            (owner_id, owner_username, full_name(owner_first, owner_last)),
+            (passenger_id, username, full_name(first_name, last_name)),
+        )
+
+
+def report_details(report, chunk_size=EXPORT_CHUNK_SIZE):
+    for date, way, price, driver, passenger in edges(report, chunk_size):
+        yield date, way, passenger[1], passenger[2], driver[1], driver[2], price
+
+
+def user_totals(report, chunk_size=EXPORT_CHUNK_SIZE):
+    """{user ID: [username, name, collect, pay]} cents, adding up the report trips."""
+    totals = {}
+    for _, _, price, driver, passenger in edges(report, chunk_size):
+        cents = to_cents(price)
+        for (uid, username, name), column in ((driver, 2), (passenger, 3)):
+            if uid not in totals:
+                totals[uid] = [username, name, 0, 0]
+            totals[uid][column] += cents
+    return totals
+
+
+def report_totals(report, chunk_size=EXPORT_CHUNK_SIZE):
+    totals = user_totals(report, chunk_size)
+    for uid in sorted(totals):
+        username, name, collect, pay = totals[uid]
+        yield username, name, from_cents(collect), from_cents(pay), from_cents(collect - pay)
+
+
+def report_transfers(report, chunk_size=EXPORT_CHUNK_SIZE, strategy=DEFAULT_SETTLEMENT):
+    """The payments of the report, settled (like the report page) with the given strategy."""
+    totals = user_totals(report, chunk_size)
+    collectors, payers, _ = split_balances(
+        {uid: totals[uid][2] - totals[uid][3] for uid in sorted(totals)}
+    )
+    payments = SETTLEMENT_STRATEGIES[strategy](collectors, list(payers))
+    for collector, transactions in payments.items():
+        for payer, cents in transactions:
+            yield (totals[payer][0], totals[payer][1], totals[collector][0], totals[collector][1],
+                   from_cents(cents))
+
+
+# kind -> (header, rows generator)
+EXPORTS = {
+    "details": (DETAILS_HEADER, report_details),
+    "totals": (TOTALS_HEADER, report_totals),
+    "transfers": (TRANSFERS_HEADER, report_transfers),
+}
+
+
+class Echo:
+    """A file-like object that just returns what's written: csv.writer() makes the lines."""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(header, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def stream_json(header, rows):
+    """A JSON list of objects (one per row, with the header as keys), a line per row."""
+    yield "["
+    separator = "\n"
+    for row in rows:
+        yield separator + json.dumps(dict(zip(header, row)), cls=DjangoJSONEncoder)
+        separator = ",\n"
+    yield "\n]\n"
+
+
+FORMATS = {
+    "csv": (stream_csv, "text/csv"),
+    "json": (stream_json, "application/json"),
+}
+
+
+def export_report(report, kind, fmt, chunk_size=EXPORT_CHUNK_SIZE):
+    """The text chunks of an export of the report: `kind` in EXPORTS, `fmt` in FORMATS."""
+    header, rows = EXPORTS[kind]
+    stream, _ = FORMATS[fmt]
+    return stream(header, rows(report, chunk_size))
@@ -0,0 +1,174 @@
+"""Suggested Car.price_per_trip, from the bus fares of the route (two tickets, by default).
+
+The fares are fetched ahead of time, asynchronously, by `manage.py refresh_fares` (e.g. from
+cron) and kept in the TRIPS_FARE_CACHE cache (shared by the web processes and the command) for
+TRIPS_FARE_CACHE_TIMEOUT seconds, per route and date. Reading a suggestion (the Car admin) only
+looks at the cache: a request never waits on the bus company site.
+
+The fetcher is pluggable (the TRIPS_FARE_FETCHER setting, a dotted path): an async function
+taking the route and a date, that returns the fares found (Decimals). The default one downloads
+the results page of TRIPS_FARE_URL and reads its prices.
+"""
+import asyncio
+import logging
+import re
+from datetime import date, timedelta
+from decimal import Decimal, InvalidOperation
+from html.parser import HTMLParser
+from urllib.request import Request, urlopen
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+FARE_URL = (
+    "https://compraonline.sittnet.net/ar/6338/Resultados.aspx"
+    "?param={route}/{date:%d-%m-%Y}/0/{date:%d-%m-%Y}"
+)
+FARE_ROUTE = "395/758"  # Origin/destination, as the fares site takes them
+FARE_FETCHER = "trips.fares.fetch_fares"
+FARE_CACHE = "default"  # Cache alias
+FARE_CACHE_TIMEOUT = 12 * 60 * 60
+FARE_DAYS_AHEAD = 7  # Dates fetched by default (and looked at for a suggestion)
+FARE_TICKETS = 2  # A trip is worth this many bus tickets
+FARE_CONCURRENCY = 4  # Simultaneous requests to the fares site
+FARE_TIMEOUT = 10  # Seconds per request
+
+
+def setting(name, default):
+    return getattr(settings, f"TRIPS_{name}", default)
+
+
+def fare_cache():
+    return caches[setting("FARE_CACHE", FARE_CACHE)]
+
+
+def fare_cache_key(route, day):
+    return f"trips:fare:{route}:{day.isoformat()}"
+
+
+def parse_price(text):
+    """Decimal of a price like "$ 1.234,50" (or "1234.50"), None if there's no number."""
+    number = re.sub(r"[^\d.,]", "", text)
+    if "," in number:  # Spanish format: dots separate thousands
+        number = number.replace(".", "").replace(",", ".")
+    try:
+        return Decimal(number) if number else None
+    except InvalidOperation:
+        return None
+
+
+class FareParser(HTMLParser):
+    """Collects the prices of a results page: the text of the elements with title="Precio"."""
+
+    def __init__(self):
+        super().__init__()
+        self.prices = []
+        self.depth = 0  # Inside a price element (and how deep)
+        self.text = []
+
+    def handle_starttag(self, tag, attrs):
+        if self.depth:
+            self.depth += 1
+        elif dict(attrs).get("title") == "Precio":
+            self.depth, self.text = 1, []
+
+    def handle_endtag(self, tag):
+        if self.depth:
+            self.depth -= 1
+            if not self.depth:
+                price = parse_price("".join(self.text))
+                if price is not None:
+                    self.prices.append(price)
+
+    def handle_data(self, data):
+        if self.depth:
+            self.text.append(data)
+
+
+def parse_fares(html):
+    parser = FareParser()
+    parser.feed(html)
+    parser.close()
+    return parser.prices
+
+
+def download(url, timeout):
+    request = Request(url, headers={"User-Agent": "carpool-fares"})
+    with urlopen(request, timeout=timeout) as response:
+        charset = response.headers.get_content_charset() or "utf-8"
+        return response.read().decode(charset, errors="replace")
+
+
+async def fetch_fares(route, day):
+    """The fares of the route on that day, from the TRIPS_FARE_URL results page.
+
+    The download is blocking (urllib): it runs on the default executor's threads.
+    """
+    url = setting("FARE_URL", FARE_URL).format(route=route, date=day)
+    loop = asyncio.get_running_loop()
+    html = await loop.run_in_executor(None, download, url, setting("FARE_TIMEOUT", FARE_TIMEOUT))
+    return parse_fares(html)
+
+
+async def fetch_all(fetcher, route, days, concurrency):
+    """{date: fares} of the days, at most `concurrency` fetches at a time.
+
+    A failing date is logged and left out (its cached fare, if any, is kept until it expires).
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(day):
+        async with semaphore:
+            try:
+                return day, await fetcher(route, day)
+            except Exception:
+                logger.warning("Couldn't fetch the fares of %s on %s", route, day, exc_info=True)
+                return day, None
+
+    results = await asyncio.gather(*(fetch(day) for day in days))
+    return {day: fares for day, fares in results if fares}
+
+
+def next_days(since=None, days=None):
+    """`days` dates (TRIPS_FARE_DAYS_AHEAD by default) from `since` (today)."""
+    since = since or date.today()
+    days = days or setting("FARE_DAYS_AHEAD", FARE_DAYS_AHEAD)
+    return [since + timedelta(days=i) for i in range(days)]
+
+
+def refresh_fares(days, route=None, fetcher=None):
+    """Fetch the fares of the route on those days and cache them (the highest one of each day).
+
+    Returns {date: fare} of the days fetched.
+    """
+    route = route or setting("FARE_ROUTE", FARE_ROUTE)
+    fetcher = fetcher or import_string(setting("FARE_FETCHER", FARE_FETCHER))
+    found = asyncio.run(
+        fetch_all(fetcher, route, days, setting("FARE_CONCURRENCY", FARE_CONCURRENCY))
+    )
+    fares = {day: max(prices) for day, prices in found.items()}
+    fare_cache().set_many(
+        {fare_cache_key(route, day): fare for day, fare in fares.items()},
+        setting("FARE_CACHE_TIMEOUT", FARE_CACHE_TIMEOUT),
+    )
+    return fares
+
+
+def cached_fares(days, route=None):
+    """{date: fare} of the days with a cached fare (a single cache lookup, no fetching)."""
+    route = route or setting("FARE_ROUTE", FARE_ROUTE)
+    keys = {fare_cache_key(route, day): day for day in days}
+    return {keys[key]: fare for key, fare in fare_cache().get_many(keys).items()}
+
+
+def suggested_price(route=None, since=None):
+    """The price per trip of TRIPS_FARE_TICKETS bus tickets, at the highest cached fare of the
+    next days. None if there's none cached (see refresh_fares())."""
+    fares = cached_fares(next_days(since), route)
+    if not fares:
+        return None
+    return max(fares.values()) * setting("FARE_TICKETS", FARE_TICKETS)
@@ -0,0 +1,163 @@
+"""Bulk import of trips (from spreadsheets, other carpool tools): see `manage.py import_trips`.
+
+Rows are dicts with a "date" (Y-m-d), a "way" (go_to or return), the "driver" username, the
+"passengers" usernames (a list, or a string separated by spaces or commas) and optional
+"notes". They're read in chunks: every chunk is validated, and its trips and passengers are
+inserted with bulk_create() (in batches as big as the DB takes), without any signal. The new
+trips are inserted with their price, passenger_count and participants already computed (and
+added to the ledger as a whole). The existing trips that get new passengers are updated at the
+end, in one pass.
+"""
+import csv
+import json
+import re
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils.dateparse import parse_date
+
+from trips.models import Balance, Car, Trip, dump_participants, price_per_passenger
+
+
+IMPORT_CHUNK_SIZE = 5000
+
+
+class InvalidRows(ValueError):
+    """Invalid rows: `errors` has (row number, message) tuples."""
+
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} invalid rows")
+        self.errors = errors
+
+
+def read_rows(f, fmt):
+    """The rows of a CSV (with a header) or JSON lines file, one at a time."""
+    if fmt == "csv":
+        yield from csv.DictReader(f)
+    else:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class TripImporter:
+    """Resolves the usernames and cars once, then validates and inserts the rows in chunks."""
+
+    def __init__(self):
+        User = get_user_model()
+        self.users = dict(User.objects.values_list("username", "pk"))
+        self.cars = {}  # Owner ID -> car ID, None if the owner has several cars
+        self.car_prices = {}  # Car ID -> (owner ID, price_per_trip, group ID)
+        for car_id, owner_id, price_per_trip, group_id in Car.objects.values_list(
+            "pk", "owner", "price_per_trip", "group"
+        ):
+            self.cars[owner_id] = None if owner_id in self.cars else car_id
+            self.car_prices[car_id] = (owner_id, price_per_trip, group_id)
+        self.joined = set()  # IDs of the existing trips that got passengers
+
+    def parse(self, row):
+        """(car ID, date, way, notes, passenger IDs) of the row. Raises ValueError if invalid."""
+        date = parse_date(str(row.get("date") or ""))
+        if date is None:
+            raise ValueError(f"invalid date {row.get('date')!r}")
+        way = row.get("way") or Trip.GOTO
+        if way not in Trip.TRIP_WAYS:
+            raise ValueError(f"invalid way {way!r}")
+        driver = self.users.get(row.get("driver"))
+        if driver is None:
+            raise ValueError(f"unknown driver {row.get('driver')!r}")
+        car_id = self.cars.get(driver)
+        if car_id is None:
+            raise ValueError(f"{row['driver']} has no car, or more than one")
+        passengers = row.get("passengers") or []
+        if isinstance(passengers, str):
+            passengers = re.split(r"[\s,]+", passengers.strip())
+        unknown = [p for p in passengers if p and p not in self.users]
+        if unknown:
+            raise ValueError(f"unknown passengers {', '.join(unknown)}")
+        passenger_ids = {self.users[p] for p in passengers if p} | {driver}
+        return car_id, date, way, row.get("notes") or "", passenger_ids
+
+    def validate(self, rows):
+        """Parse the (row number, row) pairs. Raises InvalidRows with all the invalid ones."""
+        parsed, errors = [], []
+        for number, row in rows:
+            try:
+                parsed.append(self.parse(row))
+            except (ValueError, TypeError, AttributeError) as e:
+                errors.append((number, str(e)))
+        if errors:
+            raise InvalidRows(errors)
+        return parsed
+
+    def insert(self, parsed):
+        """Insert the new trips and the passengers (of the new and the existing trips)."""
+        trips = {}  # (car ID, date, way) -> (notes, passenger IDs), merging repeated trips
+        for car_id, date, way, notes, passenger_ids in parsed:
+            trips.setdefault((car_id, date, way), (notes, set()))[1].update(passenger_ids)
+        existing = Trip.objects.ids_by_key(trips)
+
+        new, ledger = [], []
+        for (car_id, date, way), (notes, passenger_ids) in trips.items():
+            if (car_id, date, way) in existing:
+                continue
+            owner_id, price_per_trip, group_id = self.car_prices[car_id]
+            participants = passenger_ids - {owner_id}
+            price = price_per_passenger(price_per_trip, len(participants))
+            new.append(Trip(
+                car_id=car_id, date=date, way=way, notes=notes, price_per_passenger=price,
+                passenger_count=len(participants), participants=dump_participants(participants),
+            ))
+            ledger.append((group_id, owner_id, price, participants))
+        Trip.objects.bulk_create(new)
+        Balance.objects.add_trips(ledger)
+
+        trip_ids = Trip.objects.ids_by_key(trips) if new else existing  # With the new pks
+        through = Trip.passengers.through
+        through.objects.bulk_create([
+            through(trip_id=trip_ids[key], user_id=user_id)
+            for key, (_, passenger_ids) in trips.items() for user_id in passenger_ids
+        ], ignore_conflicts=True)  # Some may be registered in the existing trips already
+        self.joined.update(existing.values())
+
+    def update_prices(self, chunk_size=IMPORT_CHUNK_SIZE):
+        """Update the existing trips that got new passengers (and the ledger)."""
+        joined = sorted(self.joined)
+        for start in range(0, len(joined), chunk_size):
+            Trip.objects.filter(pk__in=joined[start:start + chunk_size]).update_prices()
+
+
+def import_trips(rows, chunk_size=IMPORT_CHUNK_SIZE, dry_run=False):
+    """Import the rows (see the module docstring), all or nothing.
+
+    With dry_run, the rows are just validated. Raises InvalidRows with every invalid row.
+    Returns the number of trips and passengers (including the drivers) in the rows.
+    """
+    importer = TripImporter()
+    errors, imported = [], {"trips": 0, "passengers": 0}
+    with transaction.atomic():
+        for chunk in chunks(enumerate(rows, 1), chunk_size):
+            try:
+                parsed = importer.validate(chunk)
+            except InvalidRows as e:
+                errors.extend(e.errors)
+                continue
+            imported["trips"] += len(parsed)
+            imported["passengers"] += sum(len(passenger_ids) for *_, passenger_ids in parsed)
+            if not dry_run and not errors:  # Keep validating the rest, but nothing is saved
+                importer.insert(parsed)
+        if errors:
+            raise InvalidRows(errors)
+        if not dry_run:
+            importer.update_prices(chunk_size)
+    return imported
@@ -0,0 +1,109 @@
+"""Opt-in per request timings: DB queries, SQL time and the Python time of the report stages.
+
+Enabled with the TRIPS_INSTRUMENTATION setting. Then InstrumentationMiddleware records every
+request and adds a Server-Timing header and a structured (JSON) log line with the numbers.
+The code to measure is wrapped in `with stage("name"):`, which does nothing (a context
+variable lookup) when there is no request being recorded.
+"""
+import json
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+
+logger = logging.getLogger(__name__)
+
+_recorder = ContextVar("trips_instrumentation_recorder", default=None)
+
+
+class Recorder:
+    """The numbers of a single request."""
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.stages = {}  # name -> [wall time, SQL time]
+
+    def __call__(self, execute, sql, params, many, context):
+        """connection.execute_wrapper() hook: count and time every query."""
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += perf_counter() - start
+            self.queries += 1
+
+    def add(self, name, wall, sql):
+        totals = self.stages.setdefault(name, [0.0, 0.0])
+        totals[0] += wall
+        totals[1] += sql
+
+
+@contextmanager
+def stage(name):
+    """Time the block as the `name` stage of the current request (if it's being recorded)."""
+    recorder = _recorder.get()
+    if recorder is None:
+        yield
+        return
+    start, sql_start = perf_counter(), recorder.sql_time
+    try:
+        yield
+    finally:
+        recorder.add(name, perf_counter() - start, recorder.sql_time - sql_start)
+
+
+class InstrumentationMiddleware:
+
+    def __init__(self, get_response):
+        if not getattr(settings, "TRIPS_INSTRUMENTATION", False):
+            raise MiddlewareNotUsed  # Django drops it: no overhead at all
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = Recorder()
+        token = _recorder.set(recorder)
+        start = perf_counter()
+        try:
+            with connection.execute_wrapper(recorder):
+                response = self.get_response(request)
+        finally:
+            _recorder.reset(token)
+        total = perf_counter() - start
+
+        response["Server-Timing"] = ", ".join(self.server_timing(recorder, total))
+        logger.info(json.dumps({
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "total_ms": round(total * 1000, 2),
+            "queries": recorder.queries,
+            "sql_ms": round(recorder.sql_time * 1000, 2),
+            "stages": {
+                name: {"ms": round(wall * 1000, 2), "python_ms": round((wall - sql) * 1000, 2)}
+                for name, (wall, sql) in recorder.stages.items()
+            },
+        }))
+        return response
+
+    def process_template_response(self, request, response):
+        """Template responses are rendered after the view: time the render as a stage."""
+        recorder = _recorder.get()
+        if recorder is not None:
+            start, sql_start = perf_counter(), recorder.sql_time
+            response.add_post_render_callback(lambda r: recorder.add(
+                "render", perf_counter() - start, recorder.sql_time - sql_start
+            ))
+        return response
+
+    @staticmethod
+    def server_timing(recorder, total):
+        yield f'db;dur={recorder.sql_time * 1000:.2f};desc="{recorder.queries} queries"'
+        for name, (wall, sql) in recorder.stages.items():
+            yield f'{name};dur={(wall - sql) * 1000:.2f};desc="{name} (Python)"'
+        yield f"total;dur={total * 1000:.2f}"
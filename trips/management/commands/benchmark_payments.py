@@ -0,0 +1,106 @@
+import json
+import subprocess
+import tracemalloc
+from time import perf_counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from trips.management.utils import rolled_back
+from trips.models import Trip
+from trips.payments import (
+    SETTLEMENT_STRATEGIES, analyze_trips_bulk, prepare_report_data, resolve_collectors_and_payers
+)
+from trips.seeding import seed_carpool
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the payments pipeline (analyze_trips, resolve_collectors_and_payers, every "
+        "settlement strategy and prepare_report_data) on seeded data of growing sizes. Prints a "
+        "JSON line per size and stage: wall time, query count and peak Python memory. The "
+        "seeded data is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--edges", default="1000,10000,100000",
+                            help="Comma separated sizes, in trip passengers (default: %(default)s)")
+        parser.add_argument("--users", type=int, default=60)
+        parser.add_argument("--cars", type=int, default=12)
+        parser.add_argument("--max-passengers", type=int, default=4)
+        parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+        parser.add_argument("--output", help="Append the JSON lines to this file too")
+
+    def handle(self, *args, **options):
+        self.commit = self.git_commit()
+        output = options["output"] and open(options["output"], "a")
+        try:
+            for edges in map(int, options["edges"].split(",")):
+                for result in self.benchmark(edges, options):
+                    line = json.dumps(result)
+                    self.stdout.write(line)
+                    if output:
+                        output.write(line + "\n")
+        finally:
+            if output:
+                output.close()
+
+    def benchmark(self, edges, options):
+        # Days needed for the requested trip passengers (drivers included) on average
+        per_day = options["cars"] * len(Trip.TRIP_WAYS) * (options["max_passengers"] + 3) / 2
+        days = max(1, round(edges / per_day))
+        results = []
+        with rolled_back():  # The seeded data
+            start = perf_counter()
+            seeded = seed_carpool(
+                users=options["users"], cars=options["cars"], days=days,
+                max_passengers=options["max_passengers"], prefix="bench", seed=options["seed"],
+            )
+            seeded["seed_seconds"] = round(perf_counter() - start, 4)
+            trips = Trip.objects.filter(car__owner__username__startswith="bench-")
+
+            analysis = {}
+            stages = [("analyze_trips", lambda: analysis.update(analyze_trips_bulk(trips)))]
+            stages.append(("resolve_collectors_and_payers", lambda: analysis.update(zip(
+                ("collectors", "payers", "even"),
+                resolve_collectors_and_payers(analysis["balance"], analysis["index"])
+            ))))
+            for name, settle in SETTLEMENT_STRATEGIES.items():
+                stages.append((f"settle_{name}", lambda settle=settle: settle(
+                    analysis["collectors"], list(analysis["payers"])
+                )))
+            stages.append(("prepare_report_data", lambda: prepare_report_data(trips)))
+
+            for stage, run in stages:
+                results.append(dict(seeded, stage=stage, **self.measure(run)))
+        return results
+
+    def measure(self, run):
+        """Wall time and queries of a run, then peak memory of another (tracemalloc is slow)."""
+        result = {"commit": self.commit, "vendor": connection.vendor}
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                start = perf_counter()
+                run()
+                result["seconds"] = round(perf_counter() - start, 6)
+            result["queries"] = len(queries)
+            tracemalloc.start()
+            try:
+                run()
+                result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        except ValueError as e:  # Balances that don't add up (not expected with cents)
+            result["error"] = repr(e)
+        return result
+
+    def git_commit(self):
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"], cwd=settings.BASE_DIR,
+                capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from trips.models import Trip
+
+
+class Command(BaseCommand):
+    help = (
+        "Check the denormalized passenger_count and participants of the trips against their "
+        "passengers (and the price of the un-reported ones). Use --fix to rewrite them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix", action="store_true", help="Save the recomputed values")
+
+    def handle(self, *args, fix=False, **options):
+        recomputed = {change.trip.pk: (change.trip, change.report_id)
+                      for change in Trip.objects.all().membership_changes()}
+        current = Trip.objects.only(
+            "passenger_count", "participants", "price_per_passenger"
+        ).in_bulk(recomputed)
+
+        wrong = []
+        for pk, (trip, report_id) in recomputed.items():
+            fields = [
+                f for f in ("passenger_count", "participants", "price_per_passenger")
+                if getattr(trip, f) != getattr(current[pk], f)
+            ]
+            if report_id is not None and "price_per_passenger" in fields:
+                # Reported trips keep their price, even if the car's price changed
+                fields.remove("price_per_passenger")
+                trip.price_per_passenger = current[pk].price_per_passenger
+            if fields:
+                wrong.append(trip)
+                self.stdout.write(f"Trip {pk}: " + ", ".join(
+                    f"{f} {getattr(current[pk], f)} != {getattr(trip, f)}" for f in fields
+                ))
+
+        if not wrong:
+            self.stdout.write(self.style.SUCCESS("All the trips are consistent."))
+        elif fix:
+            Trip.objects.bulk_update(
+                wrong, ["passenger_count", "participants", "price_per_passenger"], batch_size=500
+            )
+            self.stdout.write(self.style.SUCCESS(f"{len(wrong)} trips fixed."))
+        else:
+            raise CommandError(f"{len(wrong)} inconsistent trips (use --fix to rewrite them).")
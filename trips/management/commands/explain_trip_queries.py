@@ -0,0 +1,76 @@
+from datetime import date, timedelta
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Max, Min
+
+from trips.management.utils import rolled_back
+from trips.models import Car, Report, Trip
+from trips.seeding import seed_carpool
+
+
+class Command(BaseCommand):
+    help = (
+        "Show the EXPLAIN plans and timings of the hot Trip queries, with and without the Trip "
+        "indexes (dropped inside a transaction that is rolled back, as is any seeded data)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seed-days", type=int, default=0,
+                            help="Seed this many days of trips first (default: use the DB as is)")
+        parser.add_argument("--repeat", type=int, default=20,
+                            help="Runs per query, the best time is shown (default: %(default)s)")
+
+    def handle(self, *args, seed_days=0, repeat=20, **options):
+        with rolled_back():  # The seeded data and the dropped indexes
+            if seed_days:
+                self.seed(seed_days)
+            report = Report.objects.order_by("-pk").first()
+            queries = self.queries(report)
+
+            self.run(queries, repeat, "With the indexes")
+            with connection.cursor() as cursor:
+                for index in Trip._meta.indexes:
+                    cursor.execute(f"DROP INDEX {connection.ops.quote_name(index.name)}")
+            self.run(queries, repeat, "Without the indexes")
+
+    def queries(self, report):
+        unreported = Trip.objects.filter(report__isnull=True)
+        last_month = date.today() - timedelta(days=30)
+        return {
+            "unreported, by date": unreported.order_by("-date"),
+            "unreported exists": unreported.order_by()[:1],
+            "report trips, by date": Trip.objects.filter(report=report).order_by("date"),
+            "report date range": Report.objects.filter(pk=getattr(report, "pk", None)).annotate(
+                trips_since=Min("trips__date"), trips_until=Max("trips__date")
+            ),
+            "date hierarchy": Trip.objects.filter(date__gte=last_month).order_by("-date", "way"),
+        }
+
+    def run(self, queries, repeat, title):
+        self.stdout.write(self.style.MIGRATE_HEADING(f"{title} ({connection.vendor})"))
+        for name, queryset in queries.items():
+            best = min(self.timeit(queryset) for _ in range(repeat))
+            self.stdout.write(self.style.MIGRATE_LABEL(f"{name}: {best * 1000:.2f}ms"))
+            self.stdout.write(self.explain(queryset, title))
+
+    def explain(self, queryset, title):
+        """Like queryset.explain(), tagged so that SQLite doesn't reuse the cached plan."""
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"{connection.ops.explain_query_prefix()} {sql} -- {title}", params)
+            return "\n".join(" ".join(map(str, row)) for row in cursor.fetchall())
+
+    def timeit(self, queryset):
+        start = perf_counter()
+        list(queryset.all())  # all(): a fresh copy, not the cached results
+        return perf_counter() - start
+
+    def seed(self, days):
+        """seed_carpool() trips, all of them reported but for the last week."""
+        seeded = seed_carpool(days=days, prefix="explain", seed=0)
+        trips = Trip.objects.filter(car__owner__username__startswith="explain-")
+        report = Report.objects.create(creator=Car.objects.filter(trips__in=trips)[0].owner)
+        trips.filter(date__lt=date.today() - timedelta(days=7)).update(report=report)
+        self.stdout.write("Seeded {trips} trips.".format(**seeded))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from trips.exports import EXPORT_CHUNK_SIZE, EXPORTS, FORMATS, export_report
+from trips.models import Report
+
+
+class Command(BaseCommand):
+    help = (
+        "Export the details, per user totals or transfers of a report as CSV or JSON, streamed "
+        "(the same as the report export links)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("report", type=int, help="Report ID")
+        parser.add_argument("--kind", choices=EXPORTS, default="details")
+        parser.add_argument("--format", choices=FORMATS, default="csv", dest="fmt")
+        parser.add_argument("--output", help="File to write (default: stdout)")
+        parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE,
+                            help="Rows fetched from the DB at a time (default: %(default)s)")
+
+    def handle(self, *args, report, kind="details", fmt="csv", output=None,
+               chunk_size=EXPORT_CHUNK_SIZE, **options):
+        try:
+            report = Report.objects.get(pk=report)
+        except Report.DoesNotExist:
+            raise CommandError(f"There's no report {report}")
+
+        chunks = export_report(report, kind, fmt, chunk_size)
+        if output is None:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending="")
+        else:
+            with open(output, "w", newline="") as f:
+                f.writelines(chunks)
@@ -0,0 +1,45 @@
+import sys
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from trips.importing import IMPORT_CHUNK_SIZE, InvalidRows, import_trips, read_rows
+
+
+class Command(BaseCommand):
+    help = (
+        "Import trips from a CSV file (with date, way, driver, passengers and notes columns) or "
+        "JSON lines with the same keys. Drivers and passengers are usernames, the passengers "
+        "separated by spaces or commas (or a JSON list). Existing trips get the new passengers. "
+        "All or nothing: any invalid row aborts the import."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", help="CSV or JSON lines file, - for stdin")
+        parser.add_argument("--format", choices=("csv", "jsonl"), dest="fmt",
+                            help="Default: from the file extension (csv for stdin)")
+        parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE,
+                            help="Rows validated and inserted at a time (default: %(default)s)")
+        parser.add_argument("--dry-run", action="store_true", help="Only validate the rows")
+
+    def handle(self, *args, file, fmt=None, chunk_size=IMPORT_CHUNK_SIZE, dry_run=False,
+               **options):
+        if fmt is None:
+            fmt = "jsonl" if file.endswith((".jsonl", ".json")) else "csv"
+
+        start = perf_counter()
+        f = sys.stdin if file == "-" else open(file, newline="")
+        try:
+            imported = import_trips(read_rows(f, fmt), chunk_size=chunk_size, dry_run=dry_run)
+        except InvalidRows as e:
+            for number, error in e.errors:
+                self.stderr.write(f"Row {number}: {error}")
+            raise CommandError(f"{len(e.errors)} invalid rows, nothing imported.")
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+        outcome = "are valid" if dry_run else f"imported in {perf_counter() - start:.2f}s"
+        self.stdout.write(self.style.SUCCESS(
+            "{trips} trips with {passengers} passengers {}.".format(outcome, **imported)
+        ))
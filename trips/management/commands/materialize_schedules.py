@@ -0,0 +1,32 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from trips.models import SCHEDULE_DAYS_AHEAD, Schedule
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the trips of the schedules (with their regular passengers) for a range of days, "
+        "skipping the trips that exist already. Meant to run daily, e.g. from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", type=parse_date, help="First day (default: today)")
+        parser.add_argument("--until", type=parse_date,
+                            help=f"Last day (default: {SCHEDULE_DAYS_AHEAD} days from --since)")
+        parser.add_argument("--car", type=int, action="append", dest="cars",
+                            help="Only the schedules of this car ID (can be repeated)")
+
+    def handle(self, *args, since=None, until=None, cars=None, **options):
+        since = since or date.today()
+        until = until or since + timedelta(days=SCHEDULE_DAYS_AHEAD - 1)
+        if until < since:
+            raise CommandError("--until is before --since")
+        schedules = Schedule.objects.all()
+        if cars:
+            schedules = schedules.filter(car__in=cars)
+
+        created = schedules.materialize(since, until)
+        self.stdout.write(self.style.SUCCESS(f"{created} trips created ({since} to {until})."))
@@ -0,0 +1,28 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from trips.models import Report
+
+
+class Command(BaseCommand):
+    help = (
+        "Compute the payments of the pending reports (the ones created from the admin), one at "
+        "a time, and of the ones left running by a dead worker. Keeps waiting for new ones, "
+        "unless --once. Several workers can run at once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true",
+                            help="Exit when there are no pending reports left")
+        parser.add_argument("--interval", type=float, default=5,
+                            help="Seconds between checks for new reports (default: %(default)s)")
+
+    def handle(self, *args, once=False, interval=5, **options):
+        while True:
+            processed = Report.objects.process()
+            if processed:
+                self.stdout.write(f"{processed} reports processed.")
+            if once:
+                break
+            sleep(interval)
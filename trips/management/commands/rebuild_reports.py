@@ -0,0 +1,60 @@
+from collections import Counter
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+
+from trips.models import Report
+from trips.rebuild import REBUILD_CHUNK_SIZE, rebuild_reports
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the payments of every report (or the given ones) on a pool of processes, and "
+        "show the transfers that differ from the ones snapshotted, e.g. after a change of the "
+        "settlement logic. Use --save to keep the new snapshots."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--report", type=int, action="append", dest="reports",
+                            help="Only this report ID (can be repeated)")
+        parser.add_argument("--workers", type=int,
+                            help="Worker processes (default: one per CPU; 0: none, in-process)")
+        parser.add_argument("--chunk-size", type=int, default=REBUILD_CHUNK_SIZE,
+                            help="Reports per task (default: %(default)s)")
+        parser.add_argument("--save", action="store_true", help="Save the new snapshots")
+
+    def handle(self, *args, reports=None, workers=None, chunk_size=REBUILD_CHUNK_SIZE,
+               save=False, **options):
+        report_ids = Report.objects.values_list("pk", flat=True)
+        if reports:
+            report_ids = report_ids.filter(pk__in=reports)
+
+        start = perf_counter()
+        count = edges = changed = missing = failed = 0
+        for report in rebuild_reports(list(report_ids), workers, chunk_size, save):
+            count += 1
+            edges += report.edges
+            if report.error:
+                failed += 1
+                self.stdout.write(self.style.ERROR(f"Report {report.id}: {report.error}"))
+            elif report.old is None:
+                missing += 1
+            elif report.old != report.new:
+                changed += 1
+                self.write_diff(report)
+        elapsed = perf_counter() - start
+
+        rate = count / elapsed if elapsed else 0
+        self.stdout.write(
+            f"{count} reports ({edges} trip passengers) in {elapsed:.2f}s: {rate:.1f} reports/s. "
+            f"{changed} changed, {missing} without snapshot, {failed} failed."
+        )
+        if save:
+            self.stdout.write(self.style.SUCCESS("New snapshots saved."))
+
+    def write_diff(self, report):
+        old, new = Counter(report.old), Counter(report.new or [])
+        self.stdout.write(f"Report {report.id}:")
+        for sign, transfers in (("-", old - new), ("+", new - old)):
+            for payer, collector, ammount in sorted(transfers.elements()):
+                self.stdout.write(f"  {sign} {payer} pays {collector} ${ammount}")
@@ -0,0 +1,65 @@
+from collections import defaultdict
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.dateparse import parse_date
+
+from trips.models import Balance, Trip, ledger_deltas
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the price_per_passenger of the (un-reported) trips, e.g. after changing the "
+        "price_per_trip of a car. Trips already in a report are never changed. The price "
+        "changes are applied to the ledger balances, without rebuilding it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--car", type=int, action="append", dest="cars",
+                            help="Only the trips of this car ID (can be repeated)")
+        parser.add_argument("--since", type=parse_date, help="Only trips from this date (Y-m-d)")
+        parser.add_argument("--until", type=parse_date, help="Only trips up to this date (Y-m-d)")
+        parser.add_argument("--chunk-size", type=int, default=1000,
+                            help="Trips written per UPDATE (default: %(default)s)")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Only report how many trips would change")
+
+    def handle(self, *args, cars=None, since=None, until=None, chunk_size=1000, dry_run=False,
+               **options):
+        trips = Trip.objects.filter(report__isnull=True)
+        if cars:
+            trips = trips.filter(car__in=cars)
+        if since:
+            trips = trips.filter(date__gte=since)
+        if until:
+            trips = trips.filter(date__lte=until)
+
+        start = perf_counter()
+        changed = [
+            Trip(pk=pk, price_per_passenger=price) for pk, price, _ in trips.price_changes()
+        ]
+        computed = perf_counter()
+        if not dry_run:
+            with transaction.atomic():
+                deltas = defaultdict(lambda: [0, 0])
+                for i in range(0, len(changed), chunk_size):
+                    chunk = changed[i:i + chunk_size]
+                    states = Trip.objects.filter(pk__in=[trip.pk for trip in chunk]).ledger_states()
+                    for trip in chunk:
+                        _, _, (group_id, owner_id, price, participants) = states[trip.pk]
+                        new = (group_id, owner_id, trip.price_per_passenger, participants)
+                        ledger_deltas([(group_id, owner_id, price, participants)], sign=-1,
+                                      deltas=deltas)
+                        ledger_deltas([new], deltas=deltas)
+                    Trip.objects.bulk_update(chunk, ["price_per_passenger"])
+                Balance.objects.add(deltas)
+        written = perf_counter()
+
+        self.stdout.write(
+            f"Computed prices in {computed - start:.3f}s, "
+            f"written in {written - computed:.3f}s."
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(changed)} trips {'would change' if dry_run else 'updated'}."
+        ))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from trips.fares import FARE_DAYS_AHEAD, next_days, refresh_fares
+
+
+class Command(BaseCommand):
+    help = (
+        "Fetch the bus fares of the route for the next days and cache them, for the suggested "
+        "price per trip of the cars. Meant to run periodically, e.g. from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", type=parse_date, help="First day (default: today)")
+        parser.add_argument("--days", type=int,
+                            help=f"How many days (default: {FARE_DAYS_AHEAD})")
+        parser.add_argument("--route", help="Origin/destination (default: TRIPS_FARE_ROUTE)")
+
+    def handle(self, *args, since=None, days=None, route=None, **options):
+        days = next_days(since, days)
+        fares = refresh_fares(days, route)
+        if not fares:
+            raise CommandError("No fares found (see the warnings in the logs).")
+        for day, fare in sorted(fares.items()):
+            self.stdout.write(f"{day}: {fare}")
+        self.stdout.write(self.style.SUCCESS(f"Fares cached for {len(fares)} of {len(days)} days."))
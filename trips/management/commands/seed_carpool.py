@@ -0,0 +1,34 @@
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.utils.dateparse import parse_date
+
+from trips.seeding import seed_carpool
+
+
+class Command(BaseCommand):
+    help = "Fill the DB with synthetic users, cars and daily trips (see trips.seeding)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=30)
+        parser.add_argument("--cars", type=int, default=8)
+        parser.add_argument("--days", type=int, default=30,
+                            help="Days of go_to and return trips, per car")
+        parser.add_argument("--max-passengers", type=int, default=4,
+                            help="Per trip, besides the driver")
+        parser.add_argument("--until", type=parse_date, help="Last day of trips (default: today)")
+        parser.add_argument("--prefix", default="seed", help="Of the usernames (must be new)")
+        parser.add_argument("--seed", type=int, help="Random seed, for reproducible data")
+
+    def handle(self, *args, **options):
+        start = perf_counter()
+        created = seed_carpool(
+            users=options["users"], cars=options["cars"], days=options["days"],
+            max_passengers=options["max_passengers"], until=options["until"],
+            prefix=options["prefix"], seed=options["seed"],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            "Created {users} users, {cars} cars, {trips} trips and {edges} passengers".format(
+                **created
+            ) + f" in {perf_counter() - start:.2f}s."
+        ))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from trips.models import Balance
+from trips.payments import from_cents
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the balances of the un-reported trips from their passengers and compare them "
+        "with the ledger (of every carpool group), to catch any drift. Use --fix to rebuild the "
+        "ledger."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix", action="store_true", help="Rebuild the ledger from the trips")
+
+    def handle(self, *args, fix=False, **options):
+        ledger = Balance.objects.totals(per_group=True)
+        computed = Balance.objects.computed(per_group=True)
+
+        wrong = 0
+        keys = sorted(ledger.keys() | computed.keys(), key=lambda k: (k[0] or 0, k[1]))
+        for group_id, uid in keys:
+            current = ledger.get((group_id, uid), (0, 0))
+            expected = computed.get((group_id, uid), (0, 0))
+            if current != expected:
+                wrong += 1
+                group = f" (group {group_id})" if group_id is not None else ""
+                self.stdout.write(
+                    f"User {uid}{group}: "
+                    f"collects {from_cents(current[0])} != {from_cents(expected[0])}, "
+                    f"pays {from_cents(current[1])} != {from_cents(expected[1])}"
+                )
+
+        if not wrong:
+            self.stdout.write(self.style.SUCCESS("The ledger matches the trips."))
+        elif fix:
+            Balance.objects.rebuild()
+            self.stdout.write(self.style.SUCCESS(f"Ledger rebuilt ({wrong} balances were wrong)."))
+        else:
+            raise CommandError(f"{wrong} wrong balances (use --fix to rebuild the ledger).")
@@ -0,0 +1,21 @@
+"""Helpers of the management commands."""
+from contextlib import contextmanager
+
+from django.db import transaction
+
+
+class Rollback(Exception):
+    """Undo the transaction of rolled_back()."""
+
+
+@contextmanager
+def rolled_back():
+    """A transaction that is always rolled back: for the commands that seed data (or drop
+    indexes) only to measure the queries on it.
+    """
+    try:
+        with transaction.atomic():
+            yield
+            raise Rollback
+    except Rollback:
+        pass
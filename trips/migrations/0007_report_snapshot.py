@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0006_auto_20200328_2000'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='report',
+            name='snapshot',
+            field=models.TextField(blank=True, editable=False),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:30
+
+import json
+
+from django.db import migrations, models
+
+
+def backfill_membership(apps, schema_editor):
+    """Fill passenger_count and participants from the passengers (without the driver)."""
+    Trip = apps.get_model('trips', 'Trip')
+    trips = {}
+    for pk, owner_id, passenger in Trip.objects.values_list('pk', 'car__owner', 'passengers'):
+        trips.setdefault(pk, (owner_id, set()))[1].add(passenger)
+
+    changed = []
+    for pk, (owner_id, passengers) in trips.items():
+        passengers -= {owner_id, None}
+        changed.append(Trip(
+            pk=pk,
+            passenger_count=len(passengers),
+            participants=json.dumps(sorted(passengers), separators=(',', ':')),
+        ))
+    Trip.objects.bulk_update(changed, ['passenger_count', 'participants'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0007_report_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='participants',
+            field=models.TextField(default='[]', editable=False),
+        ),
+        migrations.AddField(
+            model_name='trip',
+            name='passenger_count',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_membership, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0008_trip_membership'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(
+                condition=models.Q(report__isnull=True), fields=['-date'],
+                name='trip_unreported_date_idx'
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['report', 'date'], name='trip_report_date_idx'),
+        ),
+    ]
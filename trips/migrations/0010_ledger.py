@@ -0,0 +1,78 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:40
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_ledger(apps, schema_editor):
+    """The balances of the un-reported trips, from their passengers (without the driver).
+
+    No car is in a carpool group yet (see 0012_carpool_groups): all of them go without a group.
+    """
+    Balance = apps.get_model('trips', 'Balance')
+    Trip = apps.get_model('trips', 'Trip')
+    edges = Trip.objects.filter(report__isnull=True).values_list(
+        'car__owner', 'price_per_passenger', 'passengers'
+    )
+    totals = defaultdict(lambda: [0, 0])
+    for owner_id, price, passenger_id in edges:
+        if None in (owner_id, price, passenger_id) or passenger_id == owner_id:
+            continue
+        cents = int(price * 100)  # A DecimalField with 2 places
+        totals[owner_id][0] += cents
+        totals[passenger_id][1] += cents
+    Balance.objects.bulk_create(
+        Balance(user_id=uid, collect=collect, pay=pay) for uid, (collect, pay) in totals.items()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0011_update_proxy_permissions'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('trips', '0009_trip_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Balance',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True, primary_key=True, serialize=False, verbose_name='ID'
+                )),
+                ('collect', models.BigIntegerField(default=0)),
+                ('pay', models.BigIntegerField(default=0)),
+                ('group', models.ForeignKey(
+                    blank=True, null=True, on_delete=django.db.models.deletion.CASCADE,
+                    related_name='balances', to='auth.Group'
+                )),
+                ('user', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE, related_name='balances',
+                    to=settings.AUTH_USER_MODEL
+                )),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='balance',
+            constraint=models.UniqueConstraint(
+                fields=('group', 'user'), name='unique_balance_per_group'
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name='balance',
+            constraint=models.UniqueConstraint(
+                condition=models.Q(group__isnull=True), fields=('user',),
+                name='unique_balance_without_group'
+            ),
+        ),
+        migrations.AddField(
+            model_name='report',
+            name='balances',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.RunPython(fill_ledger, migrations.RunPython.noop),
+    ]
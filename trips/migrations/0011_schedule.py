@@ -0,0 +1,49 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:53
+
+from django.conf import settings
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('trips', '0010_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Schedule',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True, primary_key=True, serialize=False, verbose_name='ID'
+                )),
+                ('way', models.CharField(
+                    choices=[('go_to', 'Ida'), ('return', 'Vuelta')], default='go_to', max_length=8
+                )),
+                ('weekdays', models.CharField(
+                    default='01234',
+                    help_text=(
+                        'Days of the week, from 0 (Monday) to 6 (Sunday): 01234 is Monday to '
+                        'Friday'
+                    ),
+                    max_length=7,
+                    validators=[django.core.validators.RegexValidator(
+                        '^[0-6]{1,7}$', 'Days from 0 (Monday) to 6 (Sunday)'
+                    )]
+                )),
+                ('since', models.DateField(default=django.utils.timezone.now)),
+                ('until', models.DateField(blank=True, null=True)),
+                ('car', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE, related_name='schedules',
+                    to='trips.Car'
+                )),
+                ('passengers', models.ManyToManyField(
+                    blank=True, related_name='schedules', to=settings.AUTH_USER_MODEL
+                )),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0011_update_proxy_permissions'),
+        ('trips', '0011_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='car',
+            name='group',
+            field=models.ForeignKey(
+                blank=True, null=True, on_delete=django.db.models.deletion.PROTECT,
+                related_name='cars', to='auth.Group'
+            ),
+        ),
+        migrations.AddField(
+            model_name='report',
+            name='group',
+            field=models.ForeignKey(
+                blank=True, null=True, on_delete=django.db.models.deletion.PROTECT,
+                related_name='reports', to='auth.Group'
+            ),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0012_carpool_groups'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='car',
+            name='price_per_trip',
+            field=models.DecimalField(
+                blank=True, decimal_places=2, default=0,
+                help_text='Precio sugerido: 2 pasajes de Fonobus (ver abajo).', max_digits=5
+            ),
+        ),
+    ]
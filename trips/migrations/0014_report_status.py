@@ -0,0 +1,36 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0013_car_price_help_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='report',
+            name='status',
+            field=models.CharField(
+                choices=[
+                    ('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'),
+                    ('failed', 'Failed'),
+                ],
+                default='done', editable=False, max_length=8
+            ),
+        ),
+        migrations.AddField(
+            model_name='report',
+            name='error',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='report',
+            index=models.Index(
+                condition=models.Q(status__in=['pending', 'running']), fields=['id'],
+                name='report_queue_idx'
+            ),
+        ),
+    ]
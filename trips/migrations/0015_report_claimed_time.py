@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0014_report_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='report',
+            name='claimed_time',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -1,18 +1,108 @@
+import json
 import logging
+from collections import defaultdict, namedtuple
+from datetime import timedelta
 from decimal import Decimal
+from random import random
+from time import sleep
 from django.conf import settings
-from django.db import models
+from django.contrib.auth.models import Group
+from django.core.validators import RegexValidator
+from django.db import IntegrityError, OperationalError, models, transaction
+from django.db.models import Case, F, Index, Max, Min, Q, When
 from django.db.models.constraints import UniqueConstraint
 from django.utils.timezone import now
 from django.urls import reverse
 
-from trips.payments import prepare_report_data
+from trips.instrumentation import stage
+from trips.payments import (
+    DEFAULT_SETTLEMENT, SETTLEMENT_STRATEGIES, dump_report_data, full_name, load_report_data,
+    prepare_report_data, split_balances, to_cents
+)
 
 
 logger = logging.getLogger(__name__)
 
 DESCRIPTION_MAX = 2048
 
+LEDGER_BATCH_SIZE = 500  # Balances updated per query
+# Of a trip, what its passengers pay in the ledger (see TripQuerySet.ledger_entries())
+LEDGER_ENTRY_FIELDS = ("car__group", "car__owner", "price_per_passenger", "participants")
+
+# Trip fields computed from its passengers, see TripQuerySet.membership_changes()
+MEMBERSHIP_FIELDS = ["price_per_passenger", "passenger_count", "participants"]
+
+SCHEDULE_DAYS_AHEAD = 14  # Trips materialized by default from the schedules
+
+REPORT_CLAIM_CANDIDATES = 10  # Pending reports a worker tries to claim at a time
+REPORT_CLAIM_TIMEOUT = timedelta(minutes=10)  # A running report is then reclaimed
+
+REGISTER_ATTEMPTS = 8  # Of TripQuerySet.register_passenger's transaction
+REGISTER_RETRY_DELAY = 0.01  # Seconds, doubled (with jitter) on every attempt
+
+# A trip whose passengers dependent fields changed (see TripQuerySet.membership_changes): the
+# trip with the new values, and the previous price and participants (a JSON list of user IDs)
+MembershipChange = namedtuple(
+    "MembershipChange",
+    ("trip", "report_id", "group_id", "owner_id", "old_price", "old_participants"),
+)
+
+
+def carpool_groups(user):
+    """IDs of the carpool groups (auth groups) of the user, None for superusers (all of them).
+
+    Cached on the user, for the rest of the request.
+    """
+    if user.is_superuser:
+        return None
+    if not hasattr(user, "_carpool_groups"):
+        user._carpool_groups = list(user.groups.values_list("pk", flat=True))
+    return user._carpool_groups
+
+
+def group_filter(user, field="group"):
+    """Q of the objects (through the `field` group lookup) the user can see: the ones of their
+    carpool groups, and the ones without a group, shared by everyone."""
+    groups = carpool_groups(user)
+    if groups is None:
+        return Q()
+    q = Q(**{f"{field}__isnull": True})
+    if groups:
+        q |= Q(**{f"{field}__in": groups})
+    return q
+
+
+def group_ids_filter(group_ids, field="group"):
+    """Q of the objects of those carpool groups (None for the ones without a group)."""
+    group_ids = set(group_ids)
+    q = Q(**{f"{field}__in": group_ids - {None}})
+    if None in group_ids:
+        q |= Q(**{f"{field}__isnull": True})
+    return q
+
+
+def in_carpool_group(user, group_id):
+    """Whether the user can see the objects of the group (see group_filter())."""
+    return group_id is None or user.is_superuser or group_id in carpool_groups(user)
+
+
+class CarManager(models.Manager):
+
+    def get_queryset(self):
+        # str(car) shows the owner: car choices (admin filters, forms) need it for every car
+        return super().get_queryset().select_related("owner")
+
+    def ids_for_username(self, username):
+        """(car ID, owner ID, group ID) of the car owned by the user with that username.
+
+        A single query (by the unique username), without loading the car: the QR codes are
+        scanned on every pickup. Not cached: the default cache is per process, so invalidating it
+        from a signal can't reach the other workers, and they would register passengers to a
+        deleted car (or a renamed user) until it expired.
+        Raises Car.DoesNotExist (or MultipleObjectsReturned) like get().
+        """
+        return self.values_list("pk", "owner", "group").get(owner__username=username)
+
 
 class Car(models.Model):
     description = models.CharField(max_length=DESCRIPTION_MAX, blank=True)
@@ -24,8 +114,14 @@ class Car(models.Model):
     )
     price_per_trip = models.DecimalField(
         max_digits=5, decimal_places=2, default=0, blank=True,
-        help_text="Precio sugerido: 2 pasajes de Fonobus <a target='_blank' href='https://shop.ticketonline.com.ar/trips/oneway/type/1/f/352/t/559/d/2020-03-28/iR/1/c/2020-03-28/p/1/l/es'>(ver acá)</a>."
+        help_text="Precio sugerido: 2 pasajes de Fonobus (ver abajo).",
     )  # Up to $99.999,99
+    # The carpool group of the car, and so of its trips (see group_filter()). None: shared
+    group = models.ForeignKey(
+        Group, on_delete=models.PROTECT, null=True, blank=True, related_name="cars"
+    )
+
+    objects = CarManager()
 
     def __str__(self):
         return f"Auto de {self.owner.username.capitalize()}"
@@ -33,6 +129,209 @@ class Car(models.Model):
 
 from django.core.exceptions import FieldError
 
+
+def price_per_passenger(price_per_trip, passenger_count):
+    """The price of a trip split among its passengers and the driver."""
+    return (price_per_trip / (passenger_count + 1)).quantize(Decimal('0.01'))
+
+
+def dump_participants(passenger_ids):
+    return json.dumps(sorted(passenger_ids), separators=(",", ":"))
+
+
+def ledger_deltas(trips, sign=1, deltas=None):
+    """What the trips add to (or with sign=-1, take out of) the ledger balances.
+
+    `trips` are (group ID, owner ID, price per passenger, participant IDs) tuples: the owner
+    collects the price of every participant, and each of them pays it, in the group of the car.
+    Returns (or adds to `deltas`) {(group ID, user ID): [collect, pay]} cents.
+    """
+    if deltas is None:
+        deltas = defaultdict(lambda: [0, 0])
+    for group_id, owner_id, price, participants in trips:
+        if owner_id is None or price is None or not participants:
+            continue  # Nobody pays (nor collects) for this trip
+        cents = sign * to_cents(price)
+        deltas[group_id, owner_id][0] += cents * len(participants)
+        for uid in participants:
+            deltas[group_id, uid][1] += cents
+    return deltas
+
+
+class TripQuerySet(models.QuerySet):
+
+    def price_changes(self):
+        """Compute (without saving) the price_per_passenger of all the trips in the queryset.
+
+        Uses the denormalized passenger_count: a single query, without joining the passengers.
+        Yields (trip ID, new price, report ID) for the trips whose price changes.
+        """
+        trips = self.values_list(
+            "pk", "price_per_passenger", "car__price_per_trip", "passenger_count", "report"
+        )
+        for pk, price, price_per_trip, passenger_count, report_id in trips:
+            new_price = price_per_passenger(price_per_trip, passenger_count)
+            if new_price != price:
+                yield pk, new_price, report_id
+
+    def ids_by_key(self, keys):
+        """{(car ID, date, way): trip ID} of the trips of the queryset with those keys (a set, or
+        a dict), read with a single query over their cars and date range.
+
+        How the trips just inserted are found: bulk_create() only sets the pks on PostgreSQL (and
+        not even there when ignoring conflicts).
+        """
+        if not keys:
+            return {}
+        dates = [day for _, day, _ in keys]
+        trips = self.filter(
+            date__range=(min(dates), max(dates)), car__in={car_id for car_id, _, _ in keys}
+        ).values_list("car", "date", "way", "pk")
+        return {
+            (car_id, day, way): pk for car_id, day, way, pk in trips if (car_id, day, way) in keys
+        }
+
+    def membership_changes(self):
+        """Compute (without saving) the passengers dependent fields of all the trips.
+
+        Every (trip, passenger) of the queryset is read with a single query over the passengers
+        M2M table, to get the passenger_count and participants (the driver is not a passenger,
+        even if registered as one), and the price_per_passenger.
+        Yields a MembershipChange for each trip where any of those changes, with a Trip instance
+        with just the pk and MEMBERSHIP_FIELDS set.
+        """
+        rows = Trip.objects.filter(pk__in=self.values("pk")).values_list(
+            "pk", "price_per_passenger", "passenger_count", "participants",
+            "car__price_per_trip", "car__owner", "car__group", "report", "passengers",
+        )
+        trips = {}
+        for (pk, price, count, participants, price_per_trip, owner_id, group_id, report_id,
+             passenger) in rows:
+            if pk not in trips:
+                current = (price, count, participants)
+                trips[pk] = (current, price_per_trip, owner_id, group_id, report_id, set())
+            trips[pk][-1].add(passenger)
+
+        for pk, (current, price_per_trip, owner_id, group_id, report_id,
+                 passengers) in trips.items():
+            passengers -= {owner_id, None}
+            trip = Trip(
+                pk=pk,
+                price_per_passenger=price_per_passenger(price_per_trip, len(passengers)),
+                passenger_count=len(passengers),
+                participants=dump_participants(passengers),
+            )
+            if (trip.price_per_passenger, trip.passenger_count, trip.participants) != current:
+                yield MembershipChange(
+                    trip, report_id, group_id, owner_id, current[0], current[2]
+                )
+
+    def register_passenger(self, user, car_id, owner_id, date, way):
+        """Add the user (and the car owner) to the trip of the car on that date and way.
+
+        The trip is created if needed, all in one transaction. Safe under simultaneous
+        registrations (several passengers scanning the same QR code):
+          - get_or_create() retries the get() if the unique_daily_trip_per_way_car constraint
+            fails, so the late arrivals are merged into the same trip.
+          - The trip row is locked (select_for_update, where supported), so the passengers are
+            added, and the price computed, one registration at a time.
+          - Transient errors (a locked SQLite DB, a deadlock) retry the whole transaction.
+        Returns (trip, created).
+        """
+        for attempt in range(1, REGISTER_ATTEMPTS + 1):
+            try:
+                with transaction.atomic():
+                    trip, created = self.select_for_update().get_or_create(
+                        car_id=car_id, date=date, way=way
+                    )
+                    trip.passengers.add(*{user.pk, owner_id} - {None})
+                return trip, created
+            except (IntegrityError, OperationalError) as e:
+                if attempt == REGISTER_ATTEMPTS:
+                    raise
+                logger.info("Registration attempt %s failed (%s), retrying", attempt, e)
+                sleep(REGISTER_RETRY_DELAY * 2 ** attempt * random())
+
+    def update_prices(self):
+        """Recompute the price_per_passenger, passenger_count and participants of the trips.
+
+        Computed by membership_changes() and written with a bulk_update(). The changes of the
+        un-reported trips are applied to the ledger (see Balance).
+        Returns a dict with the new prices of the trips that changed, by trip ID.
+        """
+        changed, reports, deltas = [], set(), defaultdict(lambda: [0, 0])
+        for change in self.membership_changes():
+            trip = change.trip
+            changed.append(trip)
+            reports.add(change.report_id)
+            if change.report_id is None:
+                old = (change.group_id, change.owner_id, change.old_price,
+                       json.loads(change.old_participants))
+                new = (change.group_id, change.owner_id, trip.price_per_passenger,
+                       trip.participant_ids)
+                ledger_deltas([old], sign=-1, deltas=deltas)
+                ledger_deltas([new], deltas=deltas)
+        Trip.objects.bulk_update(changed, MEMBERSHIP_FIELDS)
+        Balance.objects.add(deltas)
+        Report.clear_snapshots(reports)  # bulk_update() doesn't send post_save
+        logger.debug(f"Price per passenger updated for {len(changed)} trips")
+        return {trip.pk: trip.price_per_passenger for trip in changed}
+
+    def ledger_entries(self):
+        """(group ID, owner ID, price, participant IDs) of the trips, as
+        Balance.objects.add_trips() takes.
+
+        A single query, with the denormalized participants.
+        """
+        trips = self.values_list(*LEDGER_ENTRY_FIELDS)
+        return [(group_id, owner_id, price, json.loads(participants))
+                for group_id, owner_id, price, participants in trips]
+
+    def ledger_states(self):
+        """{trip ID: (report ID, car ID, ledger entry)} of the trips, with a single query: what
+        their balances depend on (see trips.signals, when a trip is edited).
+        """
+        trips = self.values_list("pk", "report", "car", *LEDGER_ENTRY_FIELDS)
+        return {
+            pk: (report_id, car_id, (group_id, owner_id, price, json.loads(participants)))
+            for pk, report_id, car_id, group_id, owner_id, price, participants in trips
+        }
+
+    @transaction.atomic
+    def create_report(self, creator):
+        """Put the un-reported trips of the queryset in a new Report, out of the ledger.
+
+        The trips must be of a single carpool group (the group of the report), else raises
+        ValueError. If they are all the un-reported trips of the group, the group ledger balances
+        are snapshotted on the report (its payments are settled from them, see
+        Report.get_payments_report()) and taken out of the group ledger. Otherwise the trips are
+        taken out of the ledger one by one.
+        The payments are computed in the background (see Report.status and trips.background).
+        Returns the report.
+        """
+        trips = self.filter(report__isnull=True).select_for_update()
+        entries = trips.ledger_entries()
+        groups = {group_id for group_id, *_ in entries}
+        if len(groups) > 1:
+            raise ValueError("The trips of a report must be of a single carpool group")
+        group_id = groups.pop() if groups else None
+        balances = ""
+        if len(entries) == Trip.objects.filter(report__isnull=True, car__group=group_id).count():
+            ledger = Balance.objects.filter(group=group_id)
+            totals = ledger.totals()
+            balances = json.dumps({u: c - p for u, (c, p) in totals.items()})
+            # Take out just the snapshot: what was added to the ledger since it was read stays
+            ledger.add({(group_id, u): (-c, -p) for u, (c, p) in totals.items()})
+            ledger.filter(collect=0, pay=0).delete()
+        else:
+            Balance.objects.add_trips(entries, sign=-1)
+        report = Report.objects.create(
+            creator=creator, group_id=group_id, balances=balances, status=Report.PENDING
+        )
+        trips.update(report=report)
+        return report
+
+
 class Trip(models.Model):
     GOTO = "go_to"
     RETURN = "return"
@@ -45,6 +344,9 @@ class Trip(models.Model):
         max_digits=5, decimal_places=2, null=True
     )  # Up to $99.999,99
     notes = models.CharField(max_length=DESCRIPTION_MAX, blank=True)
+    # Denormalized from passengers (without the driver) by TripQuerySet.update_prices()
+    passenger_count = models.PositiveSmallIntegerField(default=0, editable=False)
+    participants = models.TextField(default="[]", editable=False)  # JSON list of user IDs
     report = models.ForeignKey(
         "trips.Report",
         null=True,
@@ -53,10 +355,20 @@ class Trip(models.Model):
         related_name="trips"
     )
 
+    objects = TripQuerySet.as_manager()
+
     class Meta:
         constraints = [
             UniqueConstraint(fields=["date", "car", "way"], name='unique_daily_trip_per_way_car'),
         ]
+        # The unique constraint above already indexes by date (admin date hierarchy, ordering)
+        indexes = [
+            # Trips still to report: FilterTripsIfTheyHaveAReport, create_report
+            Index(fields=["-date"], name="trip_unreported_date_idx",
+                  condition=Q(report__isnull=True)),
+            # The trips of a report, by date: payments_report, ReportAdmin
+            Index(fields=["report", "date"], name="trip_report_date_idx"),
+        ]
 
     def get_absolute_url(self):
         return reverse('admin:trips_trip_change', args=(self.id,))
@@ -64,11 +376,15 @@ class Trip(models.Model):
     def __str__(self):
         return f"{self.date} {Trip.TRIP_WAYS[self.way]} en el {self.car}"
 
+    @property
+    def participant_ids(self):
+        """IDs of the passengers (not the driver), from the denormalized participants."""
+        return json.loads(self.participants)
+
     def save(self, *args, **kwargs):
         """Make sure the report is not changed (once it is set)."""
         if self.pk and self.report:
             report_id = Trip.objects.values('report__id').get(pk=self.pk)['report__id']
-            print(report_id)
             if report_id is not None and report_id != self.report.id:
                 raise ValueError("Can't change the report of a trip, once set! "
                                  "Delete all the Report if needed.")
@@ -78,17 +394,14 @@ class Trip(models.Model):
     def set_price_per_passenger(self):
         """Compute the price per passenger of the trip and set on the instance.
 
-        Triggers a self.save()
+        Written to the DB with TripQuerySet.update_prices() (no self.save()).
 
         """
-        pk_set = {p.pk for p in self.passengers.all()}
-        n_people = len(pk_set.union({self.car.owner.pk}))
-        price_per_passenger = self.car.price_per_trip / n_people
-        price_per_passenger = price_per_passenger.quantize(Decimal('0.01'))
-        if price_per_passenger != self.price_per_passenger:
-            self.price_per_passenger = price_per_passenger
-            self.save()
-            logger.debug(f"Price per passenger saved for {self}: {price_per_passenger}")
+        new_prices = Trip.objects.filter(pk=self.pk).update_prices()
+        if self.pk in new_prices:
+            self.price_per_passenger = new_prices[self.pk]
+            # Lazy formatting: str(self) queries the car and its owner
+            logger.debug("Price per passenger saved for %s: %s", self, self.price_per_passenger)
 
     def people_names(self):
         """CSV string with the passengers and driver's names"""
@@ -97,10 +410,81 @@ class Trip(models.Model):
         )
 
 
+def stale_claims():
+    """Q of the running reports claimed over REPORT_CLAIM_TIMEOUT ago (or before the claims had
+    a time): their worker died, or was restarted, without finishing them."""
+    return Q(status=Report.RUNNING) & (
+        Q(claimed_time__lt=now() - REPORT_CLAIM_TIMEOUT) | Q(claimed_time__isnull=True)
+    )
+
+
+class ReportQuerySet(models.QuerySet):
+
+    def claim(self):
+        """Mark the oldest pending report of the queryset as running, and return it.
+
+        Safe with several workers: the update only succeeds for one of them (without locks, so
+        the same on SQLite and PostgreSQL). A report that stays running too long is claimed
+        again (see stale_claims()). Returns None if there's no pending report.
+        """
+        claimable = Q(status=Report.PENDING) | stale_claims()
+        pending = self.filter(claimable).order_by("pk").values_list("pk", flat=True)
+        for pk in pending[:REPORT_CLAIM_CANDIDATES]:
+            claimed = Report.objects.filter(claimable, pk=pk).update(
+                status=Report.RUNNING, claimed_time=now()
+            )
+            if claimed:
+                return Report.objects.get(pk=pk)
+        return None
+
+    def process(self, limit=None):
+        """Compute the pending reports of the queryset, one at a time (see Report.compute()).
+
+        Returns how many were processed.
+        """
+        processed = 0
+        while limit is None or processed < limit:
+            report = self.claim()
+            if report is None:
+                break
+            report.compute()
+            processed += 1
+        return processed
+
+
 class Report(models.Model):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUSES = {PENDING: "Pending", RUNNING: "Running", DONE: "Done", FAILED: "Failed"}
     creator = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
                                 related_name="reports")
+    # The carpool group of the trips (see TripQuerySet.create_report())
+    group = models.ForeignKey(
+        Group, on_delete=models.PROTECT, null=True, blank=True, related_name="reports"
+    )
     created_time = models.DateTimeField(auto_now=False, auto_now_add=True)
+    # JSON of payments_report, computed on first access. Emptied when a trip of the report changes
+    snapshot = models.TextField(blank=True, editable=False)
+    # JSON of the ledger when the report was created, if it took all the un-reported trips:
+    # {user ID: cents}, what each one collects (or pays, if negative). Emptied like the snapshot
+    balances = models.TextField(blank=True, editable=False)
+    # Of the payments computation, in the background for the new reports (see create_report()).
+    # Done: the payments are snapshotted (or computed on demand, if the trips changed since)
+    status = models.CharField(max_length=8, choices=STATUSES.items(), default=DONE,
+                              editable=False)
+    error = models.TextField(blank=True, editable=False)  # Why it failed
+    claimed_time = models.DateTimeField(null=True, blank=True, editable=False)  # Last run start
+
+    objects = ReportQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # The queue of the workers: ReportQuerySet.claim()
+            Index(fields=["id"], name="report_queue_idx",
+                  condition=Q(status__in=["pending", "running"])),
+        ]
 
     def get_absolute_url(self):
         return reverse('admin:trips_report_change', args=(self.id,))
@@ -108,14 +492,295 @@ class Report(models.Model):
     def __str__(self):
         return f"Report ({self.id or ''}) of {str(self.created_time.date())} by {self.creator}"
 
+    @classmethod
+    def clear_snapshots(cls, report_ids):
+        """Forget the computed payments of the given reports (they are recomputed when needed)."""
+        report_ids = set(report_ids) - {None}
+        if report_ids:
+            cls.objects.filter(pk__in=report_ids).exclude(snapshot="", balances="").update(
+                snapshot="", balances=""
+            )
+
     @property
     def payments_report(self):
+        return self.get_payments_report()
+
+    @property
+    def ledger_balances(self):
+        """The ledger balances snapshotted on creation ({user ID: cents}), None if there are none.
+        """
+        if not self.balances:
+            return None
+        return {int(uid): cents for uid, cents in json.loads(self.balances).items()}
+
+    @property
+    def is_ready(self):
+        return self.status == Report.DONE
+
+    def compute(self):
+        """Compute (and snapshot) the payments of the report: done, or failed with the error."""
+        try:
+            self.get_payments_report()
+        except Exception as e:
+            logger.exception("The payments of report %s failed", self.pk)
+            self.status, self.error = Report.FAILED, f"{type(e).__name__}: {e}"
+        else:
+            self.status, self.error = Report.DONE, ""
+        Report.objects.filter(pk=self.pk).update(status=self.status, error=self.error)
+
+    def get_payments_report(self, strategy=DEFAULT_SETTLEMENT):
+        """Report data with the payments assigned by the given settlement strategy.
+
+        The data with the default strategy is stored on the snapshot field, and read from there
+        until a trip of the report changes. The payments are settled from the ledger balances
+        snapshotted on creation, if any.
+        """
+        with stage("payments_report"):
+            return self._get_payments_report(strategy)
+
+    def _get_payments_report(self, strategy):
+        if strategy == DEFAULT_SETTLEMENT and self.snapshot:
+            return load_report_data(self.snapshot)
+
         report_data = None
-        if self.trips.exists():
-            report_data = prepare_report_data(self.trips.all())
-            ordered = self.trips.order_by("date")
-            report_data.update({
-                "date_from": ordered.first().date,
-                "date_to": ordered.last().date,
-            })
+        dates = self.trips.aggregate(date_from=Min("date"), date_to=Max("date"))
+        if dates["date_from"] is not None:  # The report has trips
+            report_data = prepare_report_data(
+                self.trips.all(), strategy, balances=self.ledger_balances
+            )
+            report_data.update(dates)
+            if strategy == DEFAULT_SETTLEMENT:
+                self.snapshot = dump_report_data(report_data)
+                Report.objects.filter(pk=self.pk).update(snapshot=self.snapshot)
         return report_data
+
+
+class BalanceQuerySet(models.QuerySet):
+
+    def add(self, deltas):
+        """Add {(group ID, user ID): (collect, pay)} cents to the balances (creating the missing
+        ones).
+
+        Written with F() expressions, so simultaneous updates of a balance add up: a query per
+        group (and LEDGER_BATCH_SIZE users), plus one to find the missing balances.
+        """
+        by_group = defaultdict(dict)
+        for (group_id, uid), delta in deltas.items():
+            if uid is not None and any(delta):
+                by_group[group_id][uid] = delta
+        if not by_group:
+            return
+        for group_id, group_deltas in by_group.items():
+            balances = self.filter(group=group_id)
+            existing = set(balances.filter(user__in=group_deltas).values_list("user", flat=True))
+            if len(existing) < len(group_deltas):
+                self.bulk_create([
+                    Balance(group_id=group_id, user_id=uid)
+                    for uid in group_deltas.keys() - existing
+                ], ignore_conflicts=True)
+            uids = sorted(group_deltas)
+            for start in range(0, len(uids), LEDGER_BATCH_SIZE):
+                batch = uids[start:start + LEDGER_BATCH_SIZE]
+                balances.filter(user__in=batch).update(**{
+                    field: Case(
+                        *(When(user=uid, then=F(field) + group_deltas[uid][i]) for uid in batch),
+                        default=F(field),
+                    )
+                    for i, field in enumerate(("collect", "pay"))
+                })
+
+    def add_trips(self, trips, sign=1):
+        """Add (or with sign=-1, take out) the trips to the balances (see ledger_deltas())."""
+        self.add(ledger_deltas(trips, sign))
+
+    def totals(self, per_group=False):
+        """{user ID: (collect, pay)} cents, as in the ledger (only the non zero balances).
+
+        Adds up the groups of the queryset (filter it by group for a single one), or with
+        per_group, keyed by (group ID, user ID).
+        """
+        totals = defaultdict(lambda: [0, 0])
+        for group_id, uid, collect, pay in self.values_list("group", "user", "collect", "pay"):
+            key = (group_id, uid) if per_group else uid
+            totals[key][0] += collect
+            totals[key][1] += pay
+        return {key: tuple(total) for key, total in totals.items() if any(total)}
+
+    def group_ids(self):
+        """IDs of the carpool groups of the balances in the queryset (None for the ones without a
+        group), or None if it isn't filtered: all of them.
+        """
+        if not self.query.has_filters():
+            return None
+        return set(self.values_list("group", flat=True).distinct())
+
+    def computed(self, per_group=False):
+        """Like totals(), computed from the passengers of the un-reported trips of the groups of
+        the queryset (instead of the ledger), with a single query."""
+        return self._computed(self.group_ids(), per_group)
+
+    def _computed(self, group_ids, per_group):
+        trips = Trip.objects.filter(report__isnull=True)
+        if group_ids is not None:
+            trips = trips.filter(group_ids_filter(group_ids, "car__group"))
+        edges = trips.values_list("car__group", "car__owner", "price_per_passenger", "passengers")
+        totals = defaultdict(lambda: [0, 0])
+        for group_id, owner_id, price, passenger_id in edges:
+            if None in (owner_id, price, passenger_id) or passenger_id == owner_id:
+                continue
+            cents = to_cents(price)
+            totals[(group_id, owner_id) if per_group else owner_id][0] += cents
+            totals[(group_id, passenger_id) if per_group else passenger_id][1] += cents
+        return {key: tuple(total) for key, total in totals.items() if any(total)}
+
+    def clear(self):
+        """Empty the ledger (of the groups of the queryset)."""
+        self.all().delete()
+
+    @transaction.atomic
+    def rebuild(self):
+        """Recompute the ledger of the groups of the queryset (all of them, if it isn't filtered)
+        from the trips (see computed()). Every balance of those groups is replaced.
+        """
+        group_ids = self.group_ids()
+        ledger = Balance.objects.all()
+        if group_ids is not None:
+            ledger = ledger.filter(group_ids_filter(group_ids))
+        computed = self._computed(group_ids, per_group=True)
+        ledger.clear()
+        self.bulk_create(
+            Balance(group_id=group_id, user_id=uid, collect=collect, pay=pay)
+            for (group_id, uid), (collect, pay) in computed.items()
+        )
+
+    def current_payments(self, group_id=None):
+        """What everyone collects and pays for the un-reported trips of the carpool group, and
+        who pays whom.
+
+        Read from the group ledger (a single query) and settled with the default strategy, like
+        create_report() with all the un-reported trips of the group. Not cached: it's as cheap as
+        the ledger query, and always up to date in every process.
+        Returns a dict with the "balances" ({user ID: (collect, pay)} cents), the "people"
+        ({user ID: (username, full name)}) and the "transfers" ([(payer, collector, cents)]).
+        """
+        balances, people = {}, {}
+        rows = self.filter(group=group_id).values_list(
+            "user", "collect", "pay", "user__username", "user__first_name", "user__last_name"
+        ).order_by("user")
+        for uid, collect, pay, username, first_name, last_name in rows:
+            if collect or pay:
+                balances[uid] = (collect, pay)
+                people[uid] = (username, full_name(first_name, last_name))
+        collectors, payers, _ = split_balances({u: c - p for u, (c, p) in balances.items()})
+        payments = SETTLEMENT_STRATEGIES[DEFAULT_SETTLEMENT](collectors, payers)
+        return {
+            "balances": balances,
+            "people": people,
+            "transfers": [(t.id, c, t.ammount) for c, ts in payments.items() for t in ts],
+        }
+
+
+class Balance(models.Model):
+    """Running ledger: how much each user collects and pays (in cents) for the un-reported
+    trips of each carpool group.
+
+    Updated incrementally as the passengers and prices of the trips change (see
+    TripQuerySet.update_prices() and trips.signals), and settled by
+    TripQuerySet.create_report(). `manage.py verify_ledger` checks it against the trips.
+    """
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="balances"
+    )
+    group = models.ForeignKey(
+        Group, on_delete=models.CASCADE, null=True, blank=True, related_name="balances"
+    )
+    collect = models.BigIntegerField(default=0)
+    pay = models.BigIntegerField(default=0)
+
+    objects = BalanceQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=["group", "user"], name="unique_balance_per_group"),
+            # NULLs are distinct in the constraint above
+            UniqueConstraint(fields=["user"], condition=Q(group__isnull=True),
+                             name="unique_balance_without_group"),
+        ]
+
+    def __str__(self):
+        return f"{self.user}: {self.collect - self.pay:+} cents"
+
+
+class ScheduleQuerySet(models.QuerySet):
+
+    @transaction.atomic
+    def materialize(self, since, until):
+        """Create the trips of the schedules from `since` to `until` (both included).
+
+        The trips that exist already (someone registered first, or a previous run) are left as
+        they are. The new ones are inserted with bulk_create(), with the schedule passengers
+        (and the driver), and their prices set with a single update_prices().
+        Returns the number of trips created.
+        """
+        schedules = self.filter(
+            Q(until__isnull=True) | Q(until__gte=since), since__lte=until
+        ).select_related("car").prefetch_related("passengers")
+        wanted = {}  # (car ID, date, way) -> passenger IDs
+        for schedule in schedules:
+            passenger_ids = {p.pk for p in schedule.passengers.all()} | {schedule.car.owner_id}
+            for day in schedule.dates(since, until):
+                key = (schedule.car_id, day, schedule.way)
+                wanted.setdefault(key, set()).update(passenger_ids - {None})
+        if not wanted:
+            return 0
+
+        trips = Trip.objects.filter(
+            date__range=(since, until), car__in={car_id for car_id, _, _ in wanted}
+        )
+        existing = set(trips.values_list("car", "date", "way"))
+        new = {key: passenger_ids for key, passenger_ids in wanted.items() if key not in existing}
+        Trip.objects.bulk_create(
+            [Trip(car_id=car_id, date=day, way=way) for car_id, day, way in new],
+            ignore_conflicts=True,  # Created meanwhile: unique_daily_trip_per_way_car
+        )
+        trip_ids = Trip.objects.ids_by_key(new)
+        through = Trip.passengers.through
+        through.objects.bulk_create([
+            through(trip_id=trip_ids[key], user_id=user_id)
+            for key, passenger_ids in new.items() for user_id in passenger_ids
+        ], ignore_conflicts=True)
+        Trip.objects.filter(pk__in=trip_ids.values()).update_prices()
+        return len(new)
+
+
+class Schedule(models.Model):
+    """A trip a car makes every week, with its regular passengers.
+
+    The trips are created in bulk ahead of time (see ScheduleQuerySet.materialize() and
+    `manage.py materialize_schedules`), so the passengers only register the changes.
+    """
+    car = models.ForeignKey(Car, on_delete=models.CASCADE, related_name="schedules")
+    way = models.CharField(max_length=8, choices=Trip.TRIP_WAYS.items(), default=Trip.GOTO)
+    weekdays = models.CharField(
+        max_length=7, default="01234",
+        validators=[RegexValidator(r"^[0-6]{1,7}$", "Days from 0 (Monday) to 6 (Sunday)")],
+        help_text="Days of the week, from 0 (Monday) to 6 (Sunday): 01234 is Monday to Friday",
+    )
+    passengers = models.ManyToManyField(
+        settings.AUTH_USER_MODEL, related_name="schedules", blank=True
+    )
+    since = models.DateField(default=now)
+    until = models.DateField(null=True, blank=True)
+
+    objects = ScheduleQuerySet.as_manager()
+
+    def __str__(self):
+        return f"{Trip.TRIP_WAYS[self.way]} en el {self.car} ({self.weekdays})"
+
+    def dates(self, since, until):
+        """The days of the schedule from `since` to `until` (both included)."""
+        day, last = max(since, self.since), min(until, self.until or until)
+        while day <= last:
+            if str(day.weekday()) in self.weekdays:
+                yield day
+            day += timedelta(days=1)
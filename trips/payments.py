@@ -1,45 +1,112 @@
+import heapq
+import json
 import numpy as np
 import logging
 from collections import namedtuple
+from decimal import ROUND_HALF_UP, Decimal
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.serializers.json import DjangoJSONEncoder
+from django.urls import reverse
+from django.utils.dateparse import parse_date
+
+from trips.instrumentation import stage
+
+try:
+    from scipy import sparse as sp
+except ImportError:  # scipy is optional, only needed for the sparse balance matrix
+    sp = None
 
 
 logger = logging.getLogger(__name__)
 User = get_user_model()
 
+# With scipy installed, reports with at least this many people get a sparse balance matrix
+SPARSE_MIN_PARTICIPANTS = 500
+
+CENT = Decimal("0.01")
+
+
+def to_cents(ammount):
+    """An ammount of money (a Decimal, or an int/float/str) as an exact int number of cents."""
+    if not isinstance(ammount, Decimal):
+        ammount = Decimal(str(ammount))
+    return int(ammount.quantize(CENT, rounding=ROUND_HALF_UP).scaleb(2))
+
+
+def from_cents(cents):
+    """Back from (int or NumPy int) cents to a Decimal with 2 places."""
+    return Decimal(int(cents)).scaleb(-2)
+
+
+def participants_index(user_ids):
+    """Map the (sorted) IDs of the people involved in some trips to matrix indices."""
+    return {uid: i for i, uid in enumerate(sorted(user_ids))}
+
+
+def build_balance(rows, cols, prices, N, sparse=None):
+    """Build the N x N balance matrix (collect - pay) from (owner, passenger, cents) edges.
+
+    The balance is in int64 cents, so it's exact: every row sum is what a person collects (or
+    pays, if negative) to the cent, and all of them add up to exactly 0.
+    The matrix is a dense ndarray, or a scipy.sparse CSR matrix if `sparse` is True. When `sparse`
+    is None, the sparse format is picked for N >= SPARSE_MIN_PARTICIPANTS (if scipy is available).
+    """
+    if sparse is None:
+        sparse = sp is not None and N >= SPARSE_MIN_PARTICIPANTS
+    rows, cols = np.array(rows, np.intp), np.array(cols, np.intp)
+    prices = np.array(prices, np.int64)
+
+    if sparse:
+        if sp is None:
+            raise ImportError("scipy is required for a sparse balance matrix")
+        mtx = sp.coo_matrix((prices, (rows, cols)), shape=(N, N)).tocsr()  # Sums duplicates
+        return (mtx - mtx.transpose()).tocsr()
+
+    mtx = np.zeros((N, N), np.int64)
+    # Unbuffered scatter-add: repeated (row, col) pairs accumulate (integers, so in any order)
+    np.add.at(mtx, (rows, cols), prices)
+    return mtx - mtx.transpose()
+
 
 def analyze_trips(queryset):
     """
     Rows have collect info, columns have a payment info.
-    Cell in (row i, col j), mtx[i][j] == x  means that "i" collects $x from "j" (So "j" should pay
-    $x to "i").
+    Cell in (row i, col j), mtx[i][j] == x  means that "i" collects x cents from "j" (So "j"
+    should pay x cents to "i").
 
     C_i = The sum of row i, indicates how much "i" should collect.
     P_j = The sum of col j, indicates how much "j" should pay.
     T_i = (C_i - P_i) is the difference, telling if "i" ends up paying (negative result) or
           collecting (positive result).
 
+    Only the people travelling in the trips of the queryset (drivers and passengers) get a row
+    and a column.
+
     Returns a dict with:
         "index": dict matching matrix row-indices with User IDs
-        "balance": collect (rows) and pay (columns) matrix
-        "details": List with tuples (u,c,p) user u, travelling with car owner c, pays p
+        "balance": collect (rows) and pay (columns) matrix, in int64 cents
+        "details": List with tuples (u,c,p) user u, travelling with car owner c, pays p (a Decimal)
     """
-    N = User.objects.count()
-    index = {person.id: i for i, person in enumerate(User.objects.all())}
+    people = set(queryset.values_list("car__owner", flat=True))
+    people.update(queryset.values_list("passengers", flat=True))
+    people.discard(None)
+    index = participants_index(people)
+    N = len(index)
     details = []
 
-    mtx = np.zeros((N, N), np.float64)  # (rows, cols) of Decimals
+    mtx = np.zeros((N, N), np.int64)  # (rows, cols) of cents
 
     for trip in queryset:
         row = mtx[index[trip.car.owner.id]]  # a single Row
         for passenger in trip.passengers.exclude(id=trip.car.owner.id):
             col = index[passenger.id]
-            row[col] += float(trip.price_per_passenger)
+            row[col] += to_cents(trip.price_per_passenger)
             details.append(
                 (passenger.get_full_name(),
                  trip.car.owner.get_full_name(),
                  trip.date,
-                 float(trip.price_per_passenger),
+                 trip.price_per_passenger,
                  trip.get_absolute_url())
             )
     return {
@@ -50,29 +117,112 @@ def analyze_trips(queryset):
     }
 
 
-# Relates User IDs with an ammount
+# Columns of every (trip, passenger) edge, as loaded by analyze_trips_bulk
+EDGE_FIELDS = (
+    "id", "date", "price_per_passenger",
+    "car__owner", "car__owner__first_name", "car__owner__last_name",
+    "passengers", "passengers__first_name", "passengers__last_name",
+)
+
+
+def full_name(first_name, last_name):
+    """Same as User.get_full_name(), without needing a User instance."""
+    return f"{first_name} {last_name}".strip()
+
+
+def read_edges(queryset):
+    """Every (trip, passenger) edge of the queryset, pulled through the M2M table with one
+    values_list().
+
+    Returns the IDs of everyone travelling (drivers and passengers), the owner, passenger and
+    price (in cents) of every edge, as 3 lists, and the details of the report.
+    """
+    return collect_edges(queryset.values_list(*EDGE_FIELDS))
+
+
+def collect_edges(rows):
+    """read_edges() of the rows (with the EDGE_FIELDS) already loaded."""
+    people = set()
+    owners, passengers, prices, details = [], [], [], []
+    urls = {}  # Trip ID -> admin URL
+    for (trip_id, date, price, owner_id, owner_first, owner_last,
+         passenger_id, passenger_first, passenger_last) in rows:
+        people.add(owner_id)
+        if passenger_id is None or passenger_id == owner_id:
+            continue  # A trip without passengers, or the driver in its own car
+        if trip_id not in urls:
+            urls[trip_id] = reverse('admin:trips_trip_change', args=(trip_id,))
+        owners.append(owner_id)
+        passengers.append(passenger_id)
+        prices.append(to_cents(price))
+        details.append(
+            (full_name(passenger_first, passenger_last),
+             full_name(owner_first, owner_last),
+             date,
+             price,
+             urls[trip_id])
+        )
+    people.update(passengers)
+    people.discard(None)  # Cars without owner
+    return people, owners, passengers, prices, details
+
+
+def analyze_trips_bulk(queryset, sparse=None):
+    """Same as analyze_trips (same output), but loading all the trips data in a single query.
+
+    The edges are read with read_edges() and the collect/pay matrix is built with a NumPy
+    scatter-add over the (owner, passenger) pairs, instead of querying the passengers of each
+    trip.
+
+    The balance is a scipy.sparse matrix if `sparse` is True (see build_balance()).
+    """
+    return analyze_edges(read_edges(queryset), sparse)
+
+
+def analyze_edges(edges, sparse=None):
+    """analyze_trips_bulk() of the edges already read (see read_edges())."""
+    people, owners, passengers, prices, details = edges
+    index = participants_index(people)
+    rows = [index[u] for u in owners]
+    cols = [index[u] for u in passengers]
+
+    return {
+        "index": {i: u for u, i in index.items()},  # Reverse the current index
+        "reverse_index": index,
+        "balance": build_balance(rows, cols, prices, len(index), sparse=sparse),
+        "details": details
+    }
+
+
+# Relates User IDs with an ammount, in int cents (Decimals only in prepare_report_data's output)
 Transaction = namedtuple("Transaction", ("id", "ammount"))
 
 
 def resolve_collectors_and_payers(balance, index):
     """From the trips balance, determine who ends up paying, who collecting and who's even.
 
-    Returns 3 lists of Transactions:
+    Returns 3 lists of Transactions (in cents):
       - Users who must collect (and how much each)
       - Users who must pay (and how much each)
       - Users who are even (ammount is 0 for all of them)
     """
+    # np.asarray: the sum of a scipy.sparse balance is a (N, 1) matrix
+    totals = np.asarray(balance.sum(axis=1)).ravel().astype(np.int64)
+    return split_balances({index[idx]: ammount for idx, ammount in enumerate(totals.tolist())})
 
+
+def split_balances(totals):
+    """Like resolve_collectors_and_payers, from the {user ID: cents} each one collects (or pays,
+    if negative)."""
     collectors, payers, even = [], [], []
-    for idx, ammount in enumerate(balance.sum(axis=1)):
+    for uid, ammount in totals.items():
         if ammount > 0:
             target_list = collectors
         elif ammount < 0:
             target_list = payers
         else:
             target_list = even
-        target_list.append(Transaction(index[idx], round(abs(ammount), 2)))
-    assert all(t.ammount == 0 for t in even)
+        target_list.append(Transaction(uid, abs(ammount)))
     return collectors, payers, even
 
 
@@ -80,6 +230,8 @@ def assing_payments(collectors, payers):
     """Assing payments to collectors.
 
     Return a dict, where keys are """
+    if sum(t.ammount for t in collectors) != sum(t.ammount for t in payers):
+        raise ValueError("What the collectors collect and the payers pay doesn't add up")
 
     payments_to_collectors = {}
     for c, ammount_to_collect in collectors:
@@ -94,39 +246,221 @@ def assing_payments(collectors, payers):
             else:  # este deudor cubre lo que le falta a c, con excedente
                 excess = accum - ammount_to_collect
                 to_pay = debt.ammount - excess  # Cubre lo que falta para terminar la deuda
-                payments.append(
-                    Transaction(debt.id, round(to_pay, 2))
-                )
-                new_debt = Transaction(debt.id, round(excess, 2))
+                payments.append(Transaction(debt.id, to_pay))
+                new_debt = Transaction(debt.id, excess)
                 payers.append(new_debt)  # El resto de lo que debe pagar d se vuelve a meter al pozo
                 accum = ammount_to_collect  # Salda la deuda
         payments_to_collectors[c] = payments
         logger.info(payments_to_collectors[c])
     logger.info(payers)
-    assert len(payers) == 0
 
     return payments_to_collectors
 
 
+def settle_with_heaps(collectors, payers):
+    """Assing payments to collectors, always matching the largest creditor with the largest debtor.
+
+    Every transfer settles (at least)
+    one of both parts, so there are at most len(collectors) + len(payers) - 1 transfers.
+
+    Return a dict like assing_payments: collector IDs as keys, Transactions as values.
+    """
+    payments_to_collectors = {c.id: [] for c in collectors}
+    # heapq is a min-heap: keep negative cents. The ID breaks ties deterministically.
+    credits = [(-ammount, c) for c, ammount in collectors if ammount > 0]
+    debts = [(-ammount, p) for p, ammount in payers if ammount > 0]
+    heapq.heapify(credits)
+    heapq.heapify(debts)
+
+    while credits and debts:
+        credit, c = heapq.heappop(credits)
+        debt, p = heapq.heappop(debts)
+        cents = min(-credit, -debt)
+        payments_to_collectors[c].append(Transaction(p, cents))
+        if credit + cents < 0:  # c still has to collect
+            heapq.heappush(credits, (credit + cents, c))
+        if debt + cents < 0:  # p still has to pay
+            heapq.heappush(debts, (debt + cents, p))
+
+    if credits or debts:
+        raise ValueError(f"Unsettled cents after assigning payments: {credits or debts}")
+    return payments_to_collectors
+
+
+def zero_sum_groups(balances):
+    """Split the balances (in cents) in as many zero-sum groups as possible.
+
+    Bitmask DP over the subsets: best[mask] is the max number of zero-sum groups that can be
+    peeled off, one person at a time, from the people in mask. O(2^n * n), keep n small.
+    Returns the groups as lists of positions in `balances`.
+    """
+    n = len(balances)
+    sums = [0] * (1 << n)
+    best = [0] * (1 << n)
+    last = [0] * (1 << n)  # The person to peel off from each mask to get best[mask]
+    for mask in range(1, 1 << n):
+        low = mask & -mask
+        sums[mask] = sums[mask ^ low] + balances[low.bit_length() - 1]
+        rest = mask
+        best[mask] = -1
+        while rest:
+            bit = rest & -rest
+            if best[mask ^ bit] > best[mask]:
+                best[mask], last[mask] = best[mask ^ bit], bit
+            rest ^= bit
+        best[mask] += sums[mask] == 0
+
+    # Walk back from everyone: a group closes each time the people left add up to zero
+    groups, group, mask = [], [], (1 << n) - 1
+    while mask:
+        bit = last[mask]
+        group.append(bit.bit_length() - 1)
+        mask ^= bit
+        if sums[mask] == 0:
+            groups.append(group)
+            group = []
+    if group:
+        groups.append(group)
+    return groups
+
+
+def settle_minimal_transfers(collectors, payers, max_participants=None):
+    """Assing payments with the minimum number of transfers.
+
+    Finds the largest partition of the people in zero-sum subgroups (see zero_sum_groups) and
+    settles each subgroup on its own with settle_with_heaps, so there are n - (# of subgroups)
+    transfers. The search is exponential: above `max_participants` (by default the
+    TRIPS_MINIMAL_TRANSFERS_MAX_PARTICIPANTS setting) it falls back to settle_with_heaps.
+
+    Return a dict like assing_payments: collector IDs as keys, Transactions as values.
+    """
+    if max_participants is None:
+        max_participants = getattr(settings, "TRIPS_MINIMAL_TRANSFERS_MAX_PARTICIPANTS", 14)
+    people = [(c, ammount) for c, ammount in collectors]
+    people += [(p, -ammount) for p, ammount in payers]
+    people = [(u, cents) for u, cents in people if cents != 0]
+    if len(people) > max_participants:
+        logger.info("Too many people (%s) for minimal transfers, using heaps", len(people))
+        return settle_with_heaps(collectors, payers)
+
+    payments_to_collectors = {c.id: [] for c in collectors}
+    for group in zero_sum_groups([cents for _, cents in people]):
+        group = [people[i] for i in group]
+        payments = settle_with_heaps(
+            [Transaction(u, cents) for u, cents in group if cents > 0],
+            [Transaction(u, -cents) for u, cents in group if cents < 0],
+        )
+        for c, transactions in payments.items():
+            payments_to_collectors[c].extend(transactions)
+    return payments_to_collectors
+
+
+def count_transfers(payments):
+    return sum(len(transactions) for transactions in payments.values())
+
+
+# Available algorithms to assing payments, selectable on the report view
+SETTLEMENT_STRATEGIES = {
+    "heap": settle_with_heaps,
+    "minimal": settle_minimal_transfers,
+    "sequential": assing_payments,
+}
+DEFAULT_SETTLEMENT = "heap"
+
+
+def user_names(user_ids):
+    """Full names of the given users, by ID, fetched with a single query."""
+    users = User.objects.only("first_name", "last_name").in_bulk(set(user_ids))
+    return {uid: user.get_full_name() for uid, user in users.items()}
+
+
 def aux(p):
-    f = lambda t: "{} pays {}".format(User.objects.get(pk=t.id).get_full_name(), t.ammount)
+    names = user_names(set(p).union(t.id for payments in p.values() for t in payments))
+    f = lambda t: "{} pays {}".format(names[t.id], from_cents(t.ammount))
     for u, payments in p.items():
-        print(
-            "{} collects: {}".format(
-                User.objects.get(pk=u).get_full_name(), ", ".join(map(f, payments))
-            )
-        )
+        print("{} collects: {}".format(names[u], ", ".join(map(f, payments))))
 
 
-def prepare_report_data(queryset):
-    analysis = analyze_trips(queryset)
-    collectors, payers, even = resolve_collectors_and_payers(analysis["balance"], analysis["index"])
-    payments = assing_payments(collectors, payers)
-    fn = lambda u: User.objects.get(pk=u).get_full_name()  # Full name
-    inject_name = lambda t: (fn(t.id), t.ammount)
+def prepare_report_data(queryset, strategy=DEFAULT_SETTLEMENT, balances=None):
+    """The details of the trips and their payments, settled with the given strategy.
+
+    With `balances` ({user ID: cents}, a snapshot of the ledger) the payments are settled from
+    them, and the trips are read just for the details.
+    """
+    with stage("analyze_trips"):
+        edges = read_edges(queryset)
+    return report_data_from_edges(edges, strategy, balances)
+
+
+def report_data_from_edges(edges, strategy=DEFAULT_SETTLEMENT, balances=None, names=None):
+    """prepare_report_data() of the edges already read (see read_edges()).
+
+    The names ({user ID: full name}) of everyone involved are queried, but the ones given.
+    """
+    with stage("analyze_trips"):
+        if balances is None:
+            analysis = analyze_edges(edges)
+            people, details = analysis["reverse_index"], analysis["details"]
+        else:
+            people, *_, details = edges
+            people = sorted(people.union(balances))
+    with stage("settlement"):
+        if balances is None:
+            collectors, payers, even = resolve_collectors_and_payers(
+                analysis["balance"], analysis["index"]
+            )
+        else:
+            collectors, payers, even = split_balances({u: balances.get(u, 0) for u in people})
+        # Copies: assing_payments consumes the payers list
+        payments = SETTLEMENT_STRATEGIES[strategy](collectors, list(payers))
+        transfer_counts = {}  # To compare the strategies on the report
+        for name, settle in SETTLEMENT_STRATEGIES.items():
+            if name == strategy:
+                transfer_counts[name] = count_transfers(payments)
+                continue
+            try:
+                transfer_counts[name] = count_transfers(settle(collectors, list(payers)))
+            except ValueError:
+                logger.warning("The %s strategy couldn't assing the payments", name)
+                transfer_counts[name] = None
+    given = names or {}
+    names = {uid: given[uid] for uid in people if uid in given}
+    missing = set(people) - names.keys()
+    if missing:
+        names.update(user_names(missing))  # Everyone involved, in one query
+    inject_name = lambda t: (names[t.id], from_cents(t.ammount))  # Back to Decimal
 
     return {
-        "details": analysis["details"],
-        "payments": {fn(u): map(inject_name, transactions) for u, transactions in payments.items()},
-        "even": list(map(inject_name, even))
+        "details": details,
+        "payments": {
+            names[u]: list(map(inject_name, transactions)) for u, transactions in payments.items()
+        },
+        "even": list(map(inject_name, even)),
+        "names": names,
+        "strategy": strategy,
+        "transfer_counts": transfer_counts,
+    }
+
+
+def dump_report_data(report_data):
+    """Serialize the data of a report (see prepare_report_data) to a JSON string."""
+    return json.dumps(report_data, cls=DjangoJSONEncoder)
+
+
+def load_report_data(snapshot):
+    """Rebuild the report data serialized by dump_report_data. Dates and ammounts are parsed back.
+    """
+    report_data = json.loads(snapshot)
+    report_data["details"] = [
+        (u, c, parse_date(date), Decimal(str(p)), url)
+        for u, c, date, p, url in report_data["details"]
+    ]
+    report_data["payments"] = {
+        collector: [(name, Decimal(str(ammount))) for name, ammount in transactions]
+        for collector, transactions in report_data["payments"].items()
     }
+    report_data["even"] = [(name, Decimal(str(ammount))) for name, ammount in report_data["even"]]
+    report_data["names"] = {int(uid): name for uid, name in report_data["names"].items()}
+    for key in ("date_from", "date_to"):
+        report_data[key] = parse_date(report_data[key])
+    return report_data
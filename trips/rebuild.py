@@ -0,0 +1,111 @@
+"""Recompute the payments of many reports at once, on a pool of processes (see
+`manage.py rebuild_reports`), e.g. to check a change of the settlement logic.
+
+The reports are split in chunks, each one rebuilt in a worker process with its own DB
+connection: the trips of all the reports of the chunk are loaded with a single query, and
+their payments settled like Report.get_payments_report() does. The old (snapshotted) and the
+new transfers of every report are returned, to compare them.
+
+The models are only imported inside the functions: with the "spawn" start method, the workers
+import this module before Django is set up (see init_worker()).
+"""
+import os
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import django
+from django.apps import apps
+from django.db import connections
+
+
+REBUILD_CHUNK_SIZE = 50  # Reports per task
+
+# The transfers are sorted lists of (payer name, collector name, ammount). `old` is None if the
+# report had no snapshot, `new` if its payments couldn't be computed (see `error`)
+RebuiltReport = namedtuple("RebuiltReport", ("id", "edges", "old", "new", "error"))
+
+
+def init_worker():
+    """Each worker opens its own DB connections, never the ones inherited from the parent."""
+    if not apps.ready:
+        django.setup()
+    connections.close_all()
+
+
+def transfers(payments):
+    """The transfers of the payments of a report data, sorted."""
+    return sorted(
+        (payer, collector, ammount)
+        for collector, transactions in payments.items() for payer, ammount in transactions
+    )
+
+
+def rebuild_chunk(report_ids, save=False):
+    """Rebuild the payments of the reports, with a query for the reports and one for all their
+    trips. With save, the new snapshots are written (and the reports marked as done).
+
+    Returns a list of RebuiltReport, by report ID.
+    """
+    from trips.models import Report, Trip
+    from trips.payments import (
+        EDGE_FIELDS, collect_edges, dump_report_data, full_name, load_report_data,
+        report_data_from_edges,
+    )
+
+    reports = Report.objects.filter(pk__in=report_ids).only(
+        "pk", "snapshot", "balances"
+    ).order_by("pk")
+    rows, names = defaultdict(list), {}
+    trips = Trip.objects.filter(report__in=report_ids).values_list("report", *EDGE_FIELDS)
+    for report_id, *row in trips:
+        rows[report_id].append(row)
+        owner_id, owner_first, owner_last, passenger_id, first_name, last_name = row[3:]
+        names[owner_id] = full_name(owner_first, owner_last)
+        names[passenger_id] = full_name(first_name, last_name)
+
+    results, rebuilt = [], []
+    for report in reports:
+        report_rows = rows.get(report.pk, [])
+        old = transfers(load_report_data(report.snapshot)["payments"]) if report.snapshot else None
+        if not report_rows:  # Without trips there are no payments
+            results.append(RebuiltReport(report.pk, 0, old, None, ""))
+            continue
+        try:
+            report_data = report_data_from_edges(
+                collect_edges(report_rows), balances=report.ledger_balances, names=names
+            )
+        except ValueError as e:  # Snapshotted balances that don't add up
+            results.append(RebuiltReport(report.pk, len(report_rows), old, None, str(e)))
+            continue
+        dates = [row[1] for row in report_rows]
+        report_data.update(date_from=min(dates), date_to=max(dates))
+        results.append(
+            RebuiltReport(report.pk, len(report_rows), old, transfers(report_data["payments"]), "")
+        )
+        if save:
+            report.snapshot = dump_report_data(report_data)
+            report.status, report.error = Report.DONE, ""
+            rebuilt.append(report)
+    if rebuilt:
+        Report.objects.bulk_update(rebuilt, ["snapshot", "status", "error"])
+    return results
+
+
+def rebuild_reports(report_ids, workers=None, chunk_size=REBUILD_CHUNK_SIZE, save=False):
+    """Rebuild the reports in chunks, on `workers` processes (by default, one per CPU; 0 to
+    rebuild them in this process). Yields a RebuiltReport per report, by ID.
+    """
+    report_ids = sorted(report_ids)
+    chunks = [report_ids[i:i + chunk_size] for i in range(0, len(report_ids), chunk_size)]
+    task = partial(rebuild_chunk, save=save)
+    if workers == 0:
+        for chunk in chunks:
+            yield from task(chunk)
+        return
+
+    connections.close_all()  # Not to be shared with the (forked) workers
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                             initializer=init_worker) as executor:
+        for results in executor.map(task, chunks):
+            yield from results
@@ -0,0 +1,61 @@
+"""Synthetic carpool data, for benchmarks and for trying things out on an empty DB."""
+import random
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from trips.models import Car, Trip
+
+
+User = get_user_model()
+
+
+@transaction.atomic
+def seed_carpool(users=30, cars=8, days=30, max_passengers=4, prefix="seed", seed=None,
+                 until=None):
+    """Create `users` users, `cars` of them drivers, with a go_to and a return trip per car and
+    day (the `days` days before `until`, today by default).
+
+    Every trip carries from 1 to `max_passengers` random passengers (plus the driver, who is
+    also registered as a passenger, like the registration views do). Everything is inserted
+    with bulk_create(), and the prices computed in one pass at the end.
+    Returns a dict with the number of users, cars, trips and passengers ("edges") created.
+    """
+    rnd = random.Random(seed)
+    until = until or date.today()
+
+    User.objects.bulk_create([
+        User(username=f"{prefix}-{i}", first_name=f"{prefix.capitalize()}{i}", last_name="Seed")
+        for i in range(users)
+    ])
+    people = list(
+        User.objects.filter(username__startswith=f"{prefix}-").order_by("pk")
+        .values_list("pk", flat=True)
+    )
+    drivers = people[:cars]
+    Car.objects.bulk_create([
+        Car(owner_id=d, price_per_trip=Decimal(rnd.randrange(100, 600))) for d in drivers
+    ])
+    owners = dict(Car.objects.filter(owner__in=drivers).values_list("pk", "owner"))
+
+    keys = [
+        (car_id, until - timedelta(days=d), way)
+        for d in range(days) for car_id in owners for way in Trip.TRIP_WAYS
+    ]
+    Trip.objects.bulk_create([Trip(car_id=car_id, date=day, way=way) for car_id, day, way in keys])
+
+    rows = []
+    trips = Trip.objects.filter(car__in=owners)
+    trip_ids = trips.ids_by_key(set(keys))
+    for car_id, day, way in keys:
+        trip_id, owner = trip_ids[car_id, day, way], owners[car_id]
+        k = rnd.randint(1, max_passengers)
+        passengers = [p for p in rnd.sample(people, k + 1) if p != owner][:k]
+        for user_id in passengers + [owner]:
+            rows.append(Trip.passengers.through(trip_id=trip_id, user_id=user_id))
+    Trip.passengers.through.objects.bulk_create(rows)
+
+    trips.update_prices()
+    return {"users": users, "cars": len(owners), "trips": trips.count(), "edges": len(rows)}
@@ -1,12 +1,127 @@
-from django.db.models.signals import m2m_changed
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 
-from trips.models import Trip
+from trips.models import MEMBERSHIP_FIELDS, Balance, Car, Report, Trip, ledger_deltas
 
 
 @receiver(m2m_changed, sender=Trip.passengers.through, dispatch_uid='compute_trip_price')
 def compute_trip_price(sender, instance, action, reverse, model, pk_set, using, **kwargs):
-    """Whenever the passengers of a Trip change, the price_per_trip must be recomputed."""
-    
-    if action.startswith('post_'):
-        instance.set_price_per_passenger()
+    """Whenever the passengers of a Trip change, the price_per_trip must be recomputed.
+
+    From the users side (user.trips.add(...)), all the touched trips are updated in one pass.
+    """
+    if not reverse:
+        if action.startswith('post_'):
+            instance.set_price_per_passenger()
+    elif action in ('post_add', 'post_remove'):  # instance is a User, pk_set has Trip IDs
+        Trip.objects.filter(pk__in=pk_set).update_prices()
+    elif action == 'pre_clear':  # After the clear, the user's trips are unknown
+        instance._cleared_trip_ids = list(instance.trips.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        Trip.objects.filter(pk__in=instance.__dict__.pop('_cleared_trip_ids', [])).update_prices()
+
+
+@receiver(m2m_changed, sender=Trip.passengers.through, dispatch_uid='clear_report_passengers')
+def clear_report_on_passengers_change(sender, instance, action, reverse, model, pk_set, using,
+                                      **kwargs):
+    """The payments of a report change with the passengers of its trips."""
+    if reverse:  # instance is a User, pk_set has Trip IDs
+        if action in ('post_add', 'post_remove'):
+            trips = Trip.objects.filter(pk__in=pk_set)
+        elif action == 'pre_clear':  # After the clear, the user's trips are unknown
+            trips = instance.trips.all()
+        else:
+            return
+        Report.clear_snapshots(trips.values_list('report', flat=True))
+    elif action.startswith('post_'):
+        Report.clear_snapshots([instance.report_id])
+
+
+@receiver(post_save, sender=Trip, dispatch_uid='clear_report_trip_saved')
+@receiver(post_delete, sender=Trip, dispatch_uid='clear_report_trip_deleted')
+def clear_report_on_trip_change(sender, instance, **kwargs):
+    """The payments of a report change with the prices (or the removal) of its trips. A trip
+    taken out of (or put in) a report changes the report it was in, too."""
+    saved = getattr(instance, '_saved_state', None)
+    Report.clear_snapshots([instance.report_id, saved[0] if saved else None])
+
+
+@receiver(pre_delete, sender=Trip, dispatch_uid='ledger_trip_deleted')
+def take_deleted_trip_out_of_ledger(sender, instance, **kwargs):
+    """The passengers of a deleted (un-reported) trip don't pay for it anymore."""
+    if instance.report_id is None:
+        Balance.objects.add_trips(Trip.objects.filter(pk=instance.pk).ledger_entries(), sign=-1)
+
+
+@receiver(pre_save, sender=Trip, dispatch_uid='ledger_trip_before_save')
+def remember_saved_trip(sender, instance, **kwargs):
+    """What the ledger and the reports know of the trip before the edit (see
+    move_edited_trip() and clear_report_on_trip_change())."""
+    saved = Trip.objects.filter(pk=instance.pk).ledger_states() if instance.pk else {}
+    instance._saved_state = saved.get(instance.pk)
+
+
+@receiver(post_save, sender=Trip, dispatch_uid='ledger_trip_saved')
+def move_edited_trip(sender, instance, created, **kwargs):
+    """A trip moved to another car, into a report, or with another price: its old entry leaves
+    the ledger (if it was un-reported) and the new one comes in (if it still is). In another car,
+    its price and participants (the driver is not one) are then recomputed.
+
+    New trips don't have passengers yet.
+    """
+    old = getattr(instance, '_saved_state', None)
+    if created or old is None:
+        return
+    old_report_id, old_car_id, old_entry = old
+    if (old_report_id, old_car_id, old_entry[2]) == (
+            instance.report_id, instance.car_id, instance.price_per_passenger):
+        return
+    new_report_id, _, new_entry = Trip.objects.filter(pk=instance.pk).ledger_states()[instance.pk]
+    deltas = ledger_deltas([old_entry] if old_report_id is None else [], sign=-1)
+    ledger_deltas([new_entry] if new_report_id is None else [], deltas=deltas)
+    Balance.objects.add(deltas)
+    if instance.car_id != old_car_id:
+        Trip.objects.filter(pk=instance.pk).update_prices()
+        instance.refresh_from_db(fields=MEMBERSHIP_FIELDS)
+
+
+@receiver(pre_save, sender=Car, dispatch_uid='ledger_car_before_save')
+def remember_saved_car(sender, instance, **kwargs):
+    instance._saved_owner_and_group = (
+        Car.objects.filter(pk=instance.pk).values_list('owner', 'group').first()
+        if instance.pk else None
+    )
+
+
+@receiver(post_save, sender=Car, dispatch_uid='ledger_car_saved')
+def move_car_trips(sender, instance, created, **kwargs):
+    """The un-reported trips of a car with another owner (or group) are collected by the new
+    owner (in the new group), and their participants recomputed (the driver is not one).
+
+    A new price per trip only applies to the next trips (see `manage.py recompute_prices`).
+    """
+    old = getattr(instance, '_saved_owner_and_group', None)
+    if created or old is None or old == (instance.owner_id, instance.group_id):
+        return
+    old_owner_id, old_group_id = old
+    trips = Trip.objects.filter(car=instance, report__isnull=True)
+    entries = trips.ledger_entries()
+    deltas = ledger_deltas(
+        [(old_group_id, old_owner_id, price, passengers) for _, _, price, passengers in entries],
+        sign=-1,
+    )
+    Balance.objects.add(ledger_deltas(entries, deltas=deltas))
+    if old_owner_id != instance.owner_id:
+        trips.update_prices()
+
+
+@receiver(pre_delete, sender=Report, dispatch_uid='ledger_report_before_delete')
+def remember_report_trips(sender, instance, **kwargs):
+    # The trips are un-reported with an update, without signals
+    instance._trip_entries = instance.trips.ledger_entries()
+
+
+@receiver(post_delete, sender=Report, dispatch_uid='ledger_report_deleted')
+def put_report_trips_back_in_ledger(sender, instance, **kwargs):
+    """The trips of a deleted report are un-reported again: back in the ledger."""
+    Balance.objects.add_trips(getattr(instance, '_trip_entries', []))
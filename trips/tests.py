@@ -1,3 +1,1195 @@
-from django.test import TestCase
+import csv
+import json
+import multiprocessing
+from datetime import date, timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from tempfile import NamedTemporaryFile
+from threading import Barrier, Thread
 
-# Create your tests here.
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from time import sleep
+from unittest import mock, skipIf
+
+from trips import background, fares
+from trips.rebuild import rebuild_chunk
+from trips.exports import DETAILS_HEADER
+from trips.models import (
+    Balance, BalanceQuerySet, Car, Report, Schedule, Trip, price_per_passenger,
+)
+from trips import payments
+from trips.payments import (
+    SETTLEMENT_STRATEGIES, Transaction, analyze_trips, analyze_trips_bulk, assing_payments,
+    build_balance, count_transfers, from_cents, prepare_report_data, resolve_collectors_and_payers,
+    settle_minimal_transfers, settle_with_heaps, to_cents,
+)
+
+try:
+    from hypothesis import given, strategies as st
+except ImportError:  # hypothesis is optional (see requirements/local.txt)
+    given = None
+
+
+User = get_user_model()
+
+
+class TripsTestCase(TestCase):
+    """Three drivers sharing rides on a few days, plus a user that never travels."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ana, cls.beto, cls.caro, cls.dani = [
+            User.objects.create(username=name.lower(), first_name=name, last_name="Test")
+            for name in ("Ana", "Beto", "Caro", "Dani")
+        ]
+        User.objects.create(username="nadie", first_name="Nadie")
+        cls.car_a = Car.objects.create(owner=cls.ana, price_per_trip=Decimal("300"))
+        cls.car_b = Car.objects.create(owner=cls.beto, price_per_trip=Decimal("200"))
+        cls.car_c = Car.objects.create(owner=cls.caro, price_per_trip=Decimal("100"))
+
+        cls.make_trip(cls.car_a, date(2020, 3, 2), Trip.GOTO, cls.beto, cls.dani)
+        cls.make_trip(cls.car_a, date(2020, 3, 2), Trip.RETURN, cls.beto, cls.caro, cls.dani)
+        cls.make_trip(cls.car_b, date(2020, 3, 3), Trip.GOTO, cls.ana, cls.dani)
+        cls.make_trip(cls.car_c, date(2020, 3, 4), Trip.GOTO, cls.ana, cls.beto, cls.dani)
+        cls.make_trip(cls.car_c, date(2020, 3, 5), Trip.GOTO)  # Caro alone
+
+    @classmethod
+    def make_trip(cls, car, day, way, *passengers):
+        trip = Trip.objects.create(car=car, date=day, way=way)
+        trip.passengers.add(car.owner, *passengers)
+        return trip
+
+
+class AnalyzeTripsTest(TripsTestCase):
+
+    def test_bulk_matches_analyze_trips(self):
+        expected = analyze_trips(Trip.objects.order_by("date", "way"))
+        analysis = analyze_trips_bulk(Trip.objects.order_by("date", "way"))
+
+        self.assertEqual(analysis["index"], expected["index"])
+        self.assertEqual(analysis["reverse_index"], expected["reverse_index"])
+        np.testing.assert_array_equal(analysis["balance"], expected["balance"])
+        self.assertEqual(analysis["details"], expected["details"])
+
+    def test_bulk_query_count_does_not_grow_with_trips(self):
+        with self.assertNumQueries(1):
+            analyze_trips_bulk(Trip.objects.all())
+
+    def test_only_participants_are_indexed(self):
+        analysis = analyze_trips_bulk(Trip.objects.filter(car=self.car_b))
+
+        self.assertEqual(set(analysis["reverse_index"]), {self.ana.id, self.beto.id, self.dani.id})
+        self.assertEqual(analysis["balance"].shape, (3, 3))
+
+    @skipIf(payments.sp is None, "scipy is not installed")
+    def test_sparse_balance(self):
+        dense = analyze_trips_bulk(Trip.objects.all(), sparse=False)
+        analysis = analyze_trips_bulk(Trip.objects.all(), sparse=True)
+
+        np.testing.assert_allclose(analysis["balance"].toarray(), dense["balance"])
+        self.assertEqual(
+            resolve_collectors_and_payers(analysis["balance"], analysis["index"]),
+            resolve_collectors_and_payers(dense["balance"], dense["index"]),
+        )
+
+
+class SettlementTest(TripsTestCase):
+
+    def assertSettles(self, payments, collectors, payers):
+        collected = {c: sum(t.ammount for t in ts) for c, ts in payments.items()}
+        self.assertEqual(collected, dict(collectors))
+        paid = {}
+        for t in sum(payments.values(), []):
+            paid[t.id] = paid.get(t.id, 0) + t.ammount
+        self.assertEqual(paid, dict(payers))
+
+    def test_heaps_settle_the_trips(self):
+        analysis = analyze_trips_bulk(Trip.objects.all())
+        collectors, payers, _ = resolve_collectors_and_payers(
+            analysis["balance"], analysis["index"]
+        )
+
+        self.assertSettles(settle_with_heaps(collectors, payers), collectors, payers)
+
+    def test_sequential_settles_the_trips(self):
+        analysis = analyze_trips_bulk(Trip.objects.all())
+        collectors, payers, even = resolve_collectors_and_payers(
+            analysis["balance"], analysis["index"]
+        )
+
+        self.assertEqual(sum(t.ammount for t in collectors), sum(t.ammount for t in payers))
+        self.assertEqual([t.ammount for t in even], [0] * len(even))
+        self.assertSettles(assing_payments(collectors, list(payers)), collectors, payers)
+
+    def test_heaps_at_most_n_minus_one_transfers(self):
+        collectors = [Transaction(1, 10001), Transaction(2, 3), Transaction(3, 3333)]
+        payers = [Transaction(4, 3334), Transaction(5, 3334), Transaction(6, 3335),
+                  Transaction(7, 3334)]
+
+        payments = settle_with_heaps(collectors, payers)
+
+        self.assertSettles(payments, collectors, payers)
+        self.assertLessEqual(sum(map(len, payments.values())), 6)
+
+    def test_minimal_transfers_settles_zero_sum_groups_apart(self):
+        collectors = [Transaction(1, 800), Transaction(2, 500), Transaction(3, 400)]
+        payers = [Transaction(4, 200), Transaction(5, 600), Transaction(6, 900)]
+
+        payments = settle_minimal_transfers(collectors, payers)
+
+        self.assertSettles(payments, collectors, payers)
+        self.assertEqual(count_transfers(payments), 4)  # {1, 4, 5} and {2, 3, 6}
+        self.assertEqual(count_transfers(settle_with_heaps(collectors, payers)), 5)
+
+    def test_minimal_transfers_falls_back_to_heaps(self):
+        collectors = [Transaction(1, 1000), Transaction(2, 750), Transaction(3, 250)]
+        payers = [Transaction(4, 750), Transaction(5, 250), Transaction(6, 1000)]
+
+        self.assertEqual(settle_minimal_transfers(collectors, payers, max_participants=5),
+                         settle_with_heaps(collectors, payers))
+
+    def test_cents_conversions(self):
+        self.assertEqual(to_cents(Decimal("33.33")), 3333)
+        self.assertEqual(to_cents(Decimal("0.005")), 1)
+        self.assertEqual(to_cents(0.1 + 0.2), 30)
+        self.assertEqual(from_cents(np.int64(3333)), Decimal("33.33"))
+        self.assertEqual(str(from_cents(-5)), "-0.05")
+
+
+def given_trips(test):
+    """Run the test with hypothesis trips among 8 people: (driver, passengers, price of the trip).
+
+    Without hypothesis the test is left as is (and skipped, see PaymentsPropertiesTest).
+    """
+    if given is None:
+        return test
+    return given(st.lists(st.tuples(
+        st.integers(0, 7),
+        st.sets(st.integers(0, 7), max_size=6),
+        st.decimals(min_value=1, max_value=5000, places=2),
+    ), max_size=40))(test)
+
+
+@skipIf(given is None, "hypothesis is not installed")
+class PaymentsPropertiesTest(SimpleTestCase):
+    """Whatever the trips, the cents add up exactly and every strategy settles them."""
+
+    @staticmethod
+    def balance(trips, sparse=False):
+        rows, cols, prices = [], [], []
+        for owner, passengers, price_per_trip in trips:
+            passengers = passengers - {owner}
+            price = price_per_passenger(price_per_trip, len(passengers))
+            for passenger in passengers:
+                rows.append(owner)
+                cols.append(passenger)
+                prices.append(to_cents(price))
+        return build_balance(rows, cols, prices, 8, sparse=sparse)
+
+    @given_trips
+    def test_balances_sum_to_zero(self, trips):
+        balance = self.balance(trips)
+
+        self.assertEqual(balance.dtype, np.int64)
+        self.assertEqual(balance.sum(), 0)
+        collectors, payers, even = resolve_collectors_and_payers(
+            balance, dict(enumerate(range(8)))
+        )
+        self.assertEqual(sum(t.ammount for t in collectors), sum(t.ammount for t in payers))
+        self.assertTrue(all(t.ammount == 0 for t in even))
+
+    @given_trips
+    def test_balance_matches_decimal_arithmetic(self, trips):
+        expected = [Decimal(0)] * 8
+        for owner, passengers, price_per_trip in trips:
+            price = price_per_passenger(price_per_trip, len(passengers - {owner}))
+            for passenger in passengers - {owner}:
+                expected[owner] += price
+                expected[passenger] -= price
+
+        totals = self.balance(trips).sum(axis=1)
+        self.assertEqual([from_cents(cents) for cents in totals], expected)
+
+    @skipIf(payments.sp is None, "scipy is not installed")
+    @given_trips
+    def test_sparse_balance_is_exact(self, trips):
+        np.testing.assert_array_equal(self.balance(trips, sparse=True).toarray(),
+                                      self.balance(trips))
+
+    @given_trips
+    def test_every_strategy_settles(self, trips):
+        collectors, payers, _ = resolve_collectors_and_payers(
+            self.balance(trips), dict(enumerate(range(8)))
+        )
+        for name, settle in SETTLEMENT_STRATEGIES.items():
+            payments = settle(collectors, list(payers))
+            collected = {c: sum(t.ammount for t in ts) for c, ts in payments.items()}
+            self.assertEqual(collected, dict(collectors), name)
+            paid = {}
+            for t in sum(payments.values(), []):
+                paid[t.id] = paid.get(t.id, 0) + t.ammount
+            self.assertEqual(paid, dict(payers), name)
+
+
+class ReportPaymentsViewTest(TripsTestCase):
+
+    def setUp(self):
+        self.report = Report.objects.create(creator=self.ana)
+        Trip.objects.update(report=self.report)
+        self.client.force_login(self.ana)
+
+    def test_strategies(self):
+        url = reverse("trips:report_payments", args=(self.report.id,))
+        for strategy in ("heap", "minimal"):
+            response = self.client.get(url, {"strategy": strategy})
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context["strategy"], strategy)
+            self.assertEqual(set(response.context["transfer_counts"]),
+                             {"heap", "minimal", "sequential"})
+            self.assertNotIn(None, response.context["transfer_counts"].values())
+
+    @override_settings(TRIPS_INSTRUMENTATION=True)
+    def test_instrumentation(self):
+        url = reverse("trips:report_payments", args=(self.report.id,))
+        with self.assertLogs("trips.instrumentation", "INFO") as logs:
+            response = self.client.get(url)
+
+        timings = response["Server-Timing"]
+        for name in ("db;", "analyze_trips;", "settlement;", "payments_report;", "render;"):
+            self.assertIn(name, timings)
+        logged = json.loads(logs.records[0].getMessage())
+        self.assertEqual(logged["path"], url)
+        self.assertGreater(logged["queries"], 0)
+
+    def test_no_instrumentation_by_default(self):
+        response = self.client.get(reverse("trips:report_payments", args=(self.report.id,)))
+        self.assertFalse(response.has_header("Server-Timing"))
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class BackgroundReportsTest(TripsTestCase):
+
+    def setUp(self):
+        self.report = Trip.objects.all().create_report(self.ana)
+        self.url = reverse("trips:report_payments", args=(self.report.pk,))
+        self.client.force_login(self.ana)
+
+    def test_the_worker_computes_the_new_reports(self):
+        self.assertEqual(self.report.status, Report.PENDING)
+        response = self.client.get(self.url)
+        self.assertTemplateUsed(response, "trips/report_pending.html")
+        self.assertContains(response, '<meta http-equiv="refresh" content="2">')
+
+        out = StringIO()
+        call_command("process_reports", "--once", stdout=out)
+
+        self.assertIn("1 reports processed.", out.getvalue())
+        report = Report.objects.get(pk=self.report.pk)
+        self.assertEqual((report.status, report.error), (Report.DONE, ""))
+        self.assertNotEqual(report.snapshot, "")
+        with self.assertNumQueries(4):  # Session, user, user groups, report (with its snapshot)
+            response = self.client.get(self.url)
+        self.assertTemplateUsed(response, "trips/report.html")
+        self.assertIn("Ana Test", response.context["payments"])
+
+    def test_a_report_is_claimed_once(self):
+        self.assertEqual(Report.objects.claim(), self.report)
+        self.assertIsNone(Report.objects.claim())
+        self.assertEqual(Report.objects.get(pk=self.report.pk).status, Report.RUNNING)
+        self.assertEqual(Report.objects.process(), 0)
+
+    def test_stuck_reports_are_claimed_again(self):
+        self.assertEqual(Report.objects.claim(), self.report)
+        Report.objects.update(claimed_time=timezone.now() - timedelta(minutes=9))
+        self.assertIsNone(Report.objects.claim())
+
+        Report.objects.update(claimed_time=timezone.now() - timedelta(minutes=11))
+        self.assertEqual(Report.objects.claim(), self.report)
+        self.assertIsNone(Report.objects.claim())  # Claimed again just now
+        self.assertGreater(Report.objects.get(pk=self.report.pk).claimed_time,
+                           timezone.now() - timedelta(minutes=1))
+
+        Report.objects.update(claimed_time=timezone.now() - timedelta(minutes=11))
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "x"))
+        self.client.post(reverse("myadmin:trips_report_changelist"), {
+            "action": "retry_reports", "_selected_action": [self.report.pk],
+        })
+        self.assertEqual(Report.objects.get(pk=self.report.pk).status, Report.PENDING)
+
+    def test_failed_reports_can_be_retried(self):
+        with mock.patch.object(Report, "get_payments_report", side_effect=ValueError("boom")), \
+                self.assertLogs("trips.models", "ERROR"):
+            Report.objects.process()
+
+        report = Report.objects.get(pk=self.report.pk)
+        self.assertEqual((report.status, report.error), (Report.FAILED, "ValueError: boom"))
+        response = self.client.get(self.url)
+        self.assertContains(response, "ValueError: boom")
+        self.assertNotContains(response, "refresh")
+
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "x"))
+        self.client.post(reverse("myadmin:trips_report_changelist"), {
+            "action": "retry_reports", "_selected_action": [report.pk],
+        })
+        self.assertEqual(Report.objects.get(pk=report.pk).status, Report.PENDING)
+
+
+class ThreadExecutorTest(TransactionTestCase):
+
+    @override_settings(TRIPS_REPORTS_EXECUTOR="thread")
+    def test_reports_are_computed_on_a_thread_once_committed(self):
+        driver, passenger = [User.objects.create(username=name.lower(), first_name=name)
+                             for name in ("Driver", "Passenger")]
+        trip = Trip.objects.create(car=Car.objects.create(owner=driver, price_per_trip=90))
+        trip.passengers.add(driver, passenger)
+        report = Trip.objects.all().create_report(driver)
+
+        background.enqueue(report)
+
+        for _ in range(100):
+            report.refresh_from_db()
+            if report.status == Report.DONE:
+                break
+            sleep(0.05)
+        self.assertEqual(report.status, Report.DONE)
+        self.assertEqual(report.payments_report["payments"],
+                         {"Driver": [("Passenger", Decimal("45.00"))]})
+
+
+class RebuildReportsTest(TripsTestCase):
+
+    def setUp(self):
+        self.partial = Trip.objects.filter(car=self.car_a).create_report(self.ana)
+        self.rest = Trip.objects.filter(report__isnull=True).create_report(self.ana)  # Balances
+        Report.objects.process()  # Snapshots
+
+    def rebuild(self, *args):
+        out = StringIO()
+        call_command("rebuild_reports", "--workers", "0", "--chunk-size", "1", *args, stdout=out)
+        return out.getvalue()
+
+    def test_unchanged_reports(self):
+        with self.assertNumQueries(2):  # Reports, trips (with the names)
+            rebuilt = rebuild_chunk([self.partial.pk, self.rest.pk])
+
+        self.assertEqual([r.id for r in rebuilt], [self.partial.pk, self.rest.pk])
+        self.assertEqual(rebuilt[0].old, rebuilt[0].new)
+        self.assertIn(("Dani Test", "Ana Test", Decimal("175.00")), rebuilt[0].new)
+        self.assertIn("2 reports (15 trip passengers)", self.rebuild())
+        self.assertIn("0 changed, 0 without snapshot, 0 failed.", self.rebuild())
+
+    def test_diff_and_save(self):
+        snapshot = json.loads(Report.objects.get(pk=self.partial.pk).snapshot)
+        snapshot["payments"]["Ana Test"][0][1] = "1.00"
+        Report.objects.filter(pk=self.partial.pk).update(snapshot=json.dumps(snapshot))
+        Report.objects.filter(pk=self.rest.pk).update(snapshot="")
+
+        out = self.rebuild("--save")
+
+        self.assertIn(f"Report {self.partial.pk}:\n  - Beto Test pays Ana Test $1.00\n"
+                      f"  + Beto Test pays Ana Test $175.00\n", out)
+        self.assertIn("1 changed, 1 without snapshot, 0 failed.", out)
+        self.assertIn("0 changed, 0 without snapshot", self.rebuild())
+        self.assertEqual(Report.objects.get(pk=self.rest.pk).payments_report["payments"],
+                         prepare_report_data(self.rest.trips.all(),
+                                             balances=self.rest.ledger_balances)["payments"])
+
+
+class RebuildReportsProcessesTest(TransactionTestCase):
+
+    def setUp(self):
+        if multiprocessing.current_process().daemon:
+            self.skipTest("A --parallel test process can't start the workers")
+
+    def test_workers(self):
+        users = [User.objects.create(username=f"u{i}", first_name=f"U{i}") for i in range(4)]
+        cars = [Car.objects.create(owner=user, price_per_trip=90) for user in users[:2]]
+        for day in range(1, 7):
+            trip = Trip.objects.create(car=cars[day % 2], date=date(2020, 3, day))
+            trip.passengers.add(*users)
+            Trip.objects.filter(pk=trip.pk).create_report(users[0]).payments_report
+
+        out = StringIO()
+        call_command("rebuild_reports", "--workers", "2", "--chunk-size", "2", stdout=out)
+
+        self.assertIn("6 reports (24 trip passengers)", out.getvalue())
+        self.assertIn("0 changed, 0 without snapshot, 0 failed.", out.getvalue())
+
+
+class ReportSnapshotTest(TripsTestCase):
+
+    def setUp(self):
+        self.report = Report.objects.create(creator=self.ana)
+        Trip.objects.filter(date__lt=date(2020, 3, 5)).update(report=self.report)
+
+    def test_query_count_does_not_grow_with_people(self):
+        with self.assertNumQueries(4):  # Dates, trips, names, snapshot
+            self.report.payments_report
+        self.report.snapshot = ""
+        extra = [User.objects.create(username=f"extra{i}") for i in range(5)]
+        self.make_trip(self.car_b, date(2020, 3, 4), Trip.RETURN, *extra)
+        Trip.objects.filter(date=date(2020, 3, 4)).update(report=self.report)
+
+        with self.assertNumQueries(4):
+            report_data = self.report.payments_report
+        self.assertEqual(report_data["names"][self.ana.id], "Ana Test")
+
+    def test_snapshot_is_reused(self):
+        report_data = self.report.payments_report
+        report = Report.objects.get(pk=self.report.pk)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(report.payments_report, report_data)
+        self.assertEqual(report_data["date_from"], date(2020, 3, 2))
+        self.assertEqual(report_data["date_to"], date(2020, 3, 4))
+
+    def test_snapshot_is_cleared_when_passengers_change(self):
+        self.report.payments_report
+        trip = self.report.trips.get(car=self.car_b)
+        trip.passengers.add(self.caro)
+
+        report = Report.objects.get(pk=self.report.pk)
+        self.assertEqual(report.snapshot, "")
+        self.assertIn("Caro Test", [d[0] for d in report.payments_report["details"]])
+
+    def test_snapshot_is_cleared_from_the_users_side(self):
+        self.report.payments_report
+        self.dani.trips.clear()
+
+        self.assertEqual(Report.objects.get(pk=self.report.pk).snapshot, "")
+
+    def test_snapshot_is_cleared_when_a_trip_leaves_the_report(self):
+        self.report.payments_report
+        trip = self.report.trips.get(car=self.car_b)
+        trip.report = None
+        trip.save()
+
+        report = Report.objects.get(pk=self.report.pk)
+        self.assertEqual(report.snapshot, "")
+        self.assertEqual(report.payments_report["date_to"], date(2020, 3, 4))
+        self.assertEqual(report.trips.count(), 3)
+
+
+class TripPriceTest(TripsTestCase):
+
+    def test_prices(self):
+        prices = dict(Trip.objects.values_list("car__owner__first_name", "price_per_passenger")
+                      .filter(way=Trip.GOTO, date__lt=date(2020, 3, 5)))
+        self.assertEqual(prices, {"Ana": Decimal("100"), "Beto": Decimal("66.67"),
+                                  "Caro": Decimal("25")})
+        self.assertEqual(Trip.objects.get(date=date(2020, 3, 5)).price_per_passenger,
+                         Decimal("100"))
+
+    def test_update_prices_query_count(self):
+        Trip.objects.update(price_per_passenger=None)
+
+        with self.assertNumQueries(4):  # Passengers, bulk update, ledger balances & update
+            new_prices = Trip.objects.all().update_prices()
+        self.assertEqual(len(new_prices), 5)
+        with self.assertNumQueries(1):
+            self.assertEqual(Trip.objects.all().update_prices(), {})
+
+    def test_membership_fields(self):
+        trip = Trip.objects.get(car=self.car_a, way=Trip.RETURN)
+        self.assertEqual(trip.passenger_count, 3)
+        self.assertEqual(trip.participant_ids, sorted([self.beto.id, self.caro.id, self.dani.id]))
+
+        Trip.objects.update(passenger_count=0)
+        with self.assertRaises(CommandError):
+            call_command("check_trip_membership", stdout=StringIO())
+        call_command("check_trip_membership", "--fix", stdout=StringIO())
+        self.assertEqual(Trip.objects.get(pk=trip.pk).passenger_count, 3)
+
+    def test_prices_change_from_the_users_side(self):
+        with self.assertNumQueries(8):  # Not one price computation (nor ledger update) per trip
+            self.dani.trips.remove(*Trip.objects.filter(car=self.car_a))
+
+        self.assertEqual(
+            list(Trip.objects.filter(car=self.car_a).values_list("price_per_passenger", flat=True)
+                 .order_by("way")),
+            [Decimal("150"), Decimal("100")]
+        )
+        self.dani.trips.clear()
+        self.assertEqual(Trip.objects.get(car=self.car_b).price_per_passenger, Decimal("100"))
+
+
+class RecomputePricesCommandTest(TripsTestCase):
+
+    def test_recompute_unreported_trips(self):
+        Trip.objects.filter(car=self.car_a, way=Trip.GOTO).create_report(self.ana)
+        Car.objects.filter(pk=self.car_a.pk).update(price_per_trip=Decimal("600"))
+        out = StringIO()
+
+        call_command("recompute_prices", "--car", str(self.car_a.pk), stdout=out)
+
+        self.assertIn("1 trips updated", out.getvalue())
+        self.assertEqual(
+            dict(Trip.objects.filter(car=self.car_a).values_list("way", "price_per_passenger")),
+            {Trip.GOTO: Decimal("100"), Trip.RETURN: Decimal("150")}
+        )
+        self.assertEqual(Balance.objects.totals(), Balance.objects.computed())
+
+    def test_recompute_moves_only_the_changed_balances(self):
+        Car.objects.update(price_per_trip=Decimal("600"))
+
+        with mock.patch.object(Balance.objects, "rebuild") as rebuild:
+            call_command("recompute_prices", "--chunk-size", "1", stdout=StringIO())
+
+        rebuild.assert_not_called()
+        self.assertEqual(Balance.objects.totals(), Balance.objects.computed())
+
+    def test_dry_run(self):
+        Car.objects.update(price_per_trip=Decimal("600"))
+        out = StringIO()
+
+        call_command("recompute_prices", "--dry-run", "--since", "2020-03-04", stdout=out)
+
+        self.assertIn("2 trips would change", out.getvalue())
+        self.assertEqual(Trip.objects.get(date=date(2020, 3, 5)).price_per_passenger,
+                         Decimal("100"))
+
+
+class LedgerTest(TripsTestCase):
+
+    def assertLedgerMatchesTrips(self):
+        self.assertEqual(Balance.objects.totals(), Balance.objects.computed())
+
+    def test_ledger_follows_the_passengers(self):
+        self.assertEqual(Balance.objects.totals()[self.ana.pk], (42500, 9167))
+        self.assertLedgerMatchesTrips()
+
+        trip = Trip.objects.get(car=self.car_a, way=Trip.RETURN)
+        trip.passengers.remove(self.caro)
+        self.assertLedgerMatchesTrips()
+        self.caro.trips.add(trip, Trip.objects.get(car=self.car_b))
+        self.assertLedgerMatchesTrips()
+        self.dani.trips.clear()
+        self.assertLedgerMatchesTrips()
+        trip.delete()
+        self.assertLedgerMatchesTrips()
+
+    def test_ledger_follows_coarse_changes(self):
+        trip = Trip.objects.get(car=self.car_b)
+        trip.car = self.car_c
+        trip.save()
+        self.assertLedgerMatchesTrips()
+
+        self.car_a.owner = self.dani
+        self.car_a.save()
+        self.assertLedgerMatchesTrips()
+
+        report = Trip.objects.filter(car=self.car_a).create_report(self.ana)
+        trip.report = report
+        trip.save()
+        self.assertLedgerMatchesTrips()
+        report.delete()
+        self.assertLedgerMatchesTrips()
+
+    def test_other_edits_leave_the_ledger_alone(self):
+        trip = Trip.objects.get(car=self.car_b)
+        trip.notes = "Por la ruta"
+        car = Car.objects.get(pk=self.car_a.pk)
+        car.price_per_trip = Decimal("350")
+        with self.assertNumQueries(4):  # Each one read before its update
+            trip.save()
+            car.save()
+
+    def test_report_of_all_the_trips_settles_the_ledger(self):
+        expected = prepare_report_data(Trip.objects.all())
+        balances = Balance.objects.totals()
+
+        report = Trip.objects.filter(date__lt=date(2020, 4, 1)).create_report(self.ana)
+
+        self.assertEqual(json.loads(report.balances),
+                         {str(u): c - p for u, (c, p) in balances.items()})
+        self.assertFalse(Balance.objects.exists())
+        self.assertEqual(report.trips.count(), 5)
+        report_data = report.payments_report
+        self.assertEqual(report_data["payments"], expected["payments"])
+        self.assertEqual(report_data["even"], expected["even"])
+        self.assertEqual(report_data["details"], expected["details"])
+
+    def test_report_keeps_what_the_ledger_gets_after_its_snapshot(self):
+        read_totals = BalanceQuerySet.totals
+
+        def totals_and_a_concurrent_update(ledger, *args, **kwargs):
+            totals = read_totals(ledger, *args, **kwargs)
+            Balance.objects.add({(None, self.dani.pk): (0, 500)})
+            return totals
+
+        with mock.patch.object(BalanceQuerySet, "totals", autospec=True,
+                               side_effect=totals_and_a_concurrent_update):
+            Trip.objects.all().create_report(self.ana)
+
+        self.assertEqual(Balance.objects.totals(), {self.dani.pk: (0, 500)})
+
+    def test_partial_report_takes_its_trips_out_of_the_ledger(self):
+        report = Trip.objects.filter(car=self.car_a).create_report(self.ana)
+
+        self.assertEqual(report.balances, "")
+        self.assertLedgerMatchesTrips()
+        self.assertEqual(report.payments_report["payments"],
+                         prepare_report_data(report.trips.all())["payments"])
+
+        report.delete()  # Its trips go back to the ledger
+        self.assertEqual(Balance.objects.totals()[self.ana.pk], (42500, 9167))
+
+    def test_report_balances_are_cleared_with_the_trips(self):
+        report = Trip.objects.all().create_report(self.ana)
+        report.trips.get(car=self.car_b).passengers.add(self.caro)
+
+        report.refresh_from_db()
+        self.assertEqual(report.balances, "")
+        self.assertIn("Caro Test", [d[0] for d in report.payments_report["details"]])
+
+    def test_verify_ledger(self):
+        call_command("verify_ledger", stdout=StringIO())
+        Balance.objects.filter(user=self.beto).update(pay=0)
+        out = StringIO()
+
+        with self.assertRaisesMessage(CommandError, "1 wrong balances"):
+            call_command("verify_ledger", stdout=out)
+        self.assertIn(f"User {self.beto.pk}: collects 133.34 != 133.34, pays 0.00 != 200.00",
+                      out.getvalue())
+        call_command("verify_ledger", "--fix", stdout=out)
+        self.assertLedgerMatchesTrips()
+
+
+class CurrentBalancesTest(TripsTestCase):
+
+    def setUp(self):
+        self.client.force_login(self.dani)
+
+    def test_matches_a_report_of_the_unreported_trips(self):
+        Trip.objects.filter(car=self.car_c).create_report(self.caro)
+        data = self.client.get(reverse("trips:current_balances")).json()
+
+        report = Trip.objects.filter(report__isnull=True).create_report(self.ana)
+        names = {u.username: u.get_full_name() for u in User.objects.all()}
+        payments = {}
+        for t in data["payments"]:
+            payments.setdefault(names[t["to"]], []).append(
+                (names[t["from"]], Decimal(t["ammount"]))
+            )
+        self.assertEqual(payments, {
+            name: transactions
+            for name, transactions in report.payments_report["payments"].items() if transactions
+        })
+        self.assertEqual(sum(Decimal(b["balance"]) for b in data["balances"]), 0)
+
+    def test_user_balance(self):
+        response = self.client.get(reverse("trips:current_user_balance", args=["dani"]))
+
+        self.assertEqual(response.json(), {
+            "username": "dani", "name": "Dani Test",
+            "collects": "0.00", "pays": "266.67", "balance": "-266.67",
+            "pays_to": [{"username": "ana", "ammount": "266.67"}], "collects_from": [],
+        })
+        response = self.client.get(reverse("trips:current_user_balance", args=["nadie"]))
+        self.assertEqual(response.json()["balance"], "0.00")
+        response = self.client.get(reverse("trips:current_user_balance", args=["nobody"]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_follows_the_ledger(self):
+        url = reverse("trips:current_balances")
+        with self.assertNumQueries(4):  # Session, user, user groups, ledger
+            self.client.get(url)
+
+        Trip.objects.get(car=self.car_b).passengers.add(self.caro)
+        response = self.client.get(url)
+        caro = [b for b in response.json()["balances"] if b["username"] == "caro"][0]
+        self.assertEqual(caro["pays"], "125.00")  # 75 + 50 (car_b is now shared by 4)
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class CarpoolGroupsTest(TripsTestCase):
+    """The cars of Ana and Beto are in the "norte" group, a new car of Eva in the "sur" one."""
+
+    def setUp(self):
+        self.norte, self.sur = Group.objects.create(name="norte"), Group.objects.create(name="sur")
+        for car in (self.car_a, self.car_b):
+            car.group = self.norte
+            car.save()
+        self.eva = User.objects.create(username="eva", first_name="Eva", is_staff=True)
+        self.eva.groups.add(self.sur)
+        self.eva.user_permissions.add(*Permission.objects.filter(codename__in=["view_trip"]))
+        self.car_e = Car.objects.create(owner=self.eva, price_per_trip=Decimal("100"),
+                                        group=self.sur)
+        self.make_trip(self.car_e, date(2020, 3, 2), Trip.GOTO, self.dani)
+        self.dani.groups.add(self.norte)
+
+    def test_ledger_per_group(self):
+        totals = Balance.objects.totals(per_group=True)
+
+        self.assertEqual(totals, Balance.objects.computed(per_group=True))
+        self.assertEqual(totals[self.sur.pk, self.eva.pk], (5000, 0))
+        self.assertEqual(totals[self.sur.pk, self.dani.pk], (0, 5000))
+        self.assertEqual(Balance.objects.filter(group=self.norte).totals()[self.ana.pk],
+                         (42500, 6667))  # Not paying for Caro's car, still without a group
+        self.assertEqual(Balance.objects.totals()[self.dani.pk], (0, 31667))  # All the groups
+
+    def test_rebuild_of_a_group(self):
+        Balance.objects.update(collect=0)
+
+        Balance.objects.filter(group=self.sur).rebuild()
+        self.assertEqual(Balance.objects.filter(group=self.sur).totals(),
+                         Balance.objects.filter(group=self.sur).computed())
+        self.assertEqual(Balance.objects.filter(group=self.norte).totals()[self.ana.pk],
+                         (0, 6667))  # Not rebuilt
+
+        Balance.objects.filter(user=self.dani).rebuild()  # All the groups of Dani
+        self.assertEqual(Balance.objects.totals(per_group=True),
+                         Balance.objects.computed(per_group=True))
+
+    def test_reports_of_a_single_group(self):
+        with self.assertRaisesMessage(ValueError, "single carpool group"):
+            Trip.objects.filter(date=date(2020, 3, 2)).create_report(self.ana)
+
+        report = Trip.objects.filter(car__group=self.norte).create_report(self.ana)
+
+        self.assertEqual(report.group, self.norte)
+        self.assertEqual(json.loads(report.balances)[str(self.dani.pk)], -24167)
+        self.assertFalse(Balance.objects.filter(group=self.norte).exists())
+        self.assertEqual(Balance.objects.filter(group=self.sur).totals()[self.dani.pk], (0, 5000))
+        self.assertEqual(Balance.objects.totals(per_group=True),
+                         Balance.objects.computed(per_group=True))
+
+    def test_views_are_scoped_to_the_user_groups(self):
+        report = Trip.objects.filter(car=self.car_e).create_report(self.eva)
+        self.client.force_login(self.ana)  # Without groups: only what has no group
+
+        self.assertEqual(self.client.get(
+            reverse("trips:report_payments", args=(report.pk,))
+        ).status_code, 404)
+        self.assertEqual(self.client.post(
+            reverse("trips:register_now", args=["eva"])
+        ).status_code, 404)
+        self.client.force_login(self.dani)
+        data = self.client.get(reverse("trips:current_balances")).json()
+        self.assertEqual({b["username"] for b in data["balances"]},
+                         {"ana", "beto", "caro", "dani"})
+        self.assertEqual(self.client.get(
+            reverse("trips:current_balances"), {"group": self.sur.pk}
+        ).status_code, 404)
+
+        self.client.force_login(self.eva)
+        self.assertEqual(self.client.get(
+            reverse("trips:report_payments", args=(report.pk,))
+        ).status_code, 200)
+        response = self.client.get(reverse("myadmin:trips_trip_changelist"))
+        self.assertEqual({trip.car for trip in response.context["cl"].result_list},
+                         {self.car_c, self.car_e})  # Caro's car has no group: shared
+
+
+class ReportExportTest(TripsTestCase):
+
+    def setUp(self):
+        self.report = Trip.objects.all().create_report(self.ana)
+        self.client.force_login(self.ana)
+
+    def export(self, kind, **params):
+        response = self.client.get(
+            reverse("trips:report_export", args=(self.report.pk, kind)), params
+        )
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content).decode()
+
+    def test_details_csv(self):
+        rows = list(csv.reader(StringIO(self.export("details"))))
+
+        self.assertEqual(rows[0], list(DETAILS_HEADER))
+        self.assertEqual(len(rows), 11)  # The 10 passengers that pay
+        self.assertEqual(rows[1], ["2020-03-02", "go_to", "beto", "Beto Test", "ana", "Ana Test",
+                                   "100.00"])
+
+    def test_totals_and_transfers_match_the_report(self):
+        report_data = self.report.payments_report
+        totals = json.loads(self.export("totals", format="json"))
+        transfers = json.loads(self.export("transfers", format="json"))
+
+        self.assertEqual({t["username"]: t["balance"] for t in totals},
+                         {"ana": "333.33", "beto": "-66.66", "caro": "0.00", "dani": "-266.67"})
+        payments = {}
+        for t in transfers:
+            payments.setdefault(t["collector_name"], []).append(
+                (t["payer_name"], Decimal(t["ammount"]))
+            )
+        self.assertEqual(payments, {c: ts for c, ts in report_data["payments"].items() if ts})
+
+    def test_export_command(self):
+        out = StringIO()
+        call_command("export_report", str(self.report.pk), "--kind", "totals", "--chunk-size", "2",
+                     stdout=out)
+
+        self.assertEqual(out.getvalue().splitlines()[1], "ana,Ana Test,425.00,91.67,333.33")
+        self.assertEqual(self.client.get(
+            reverse("trips:report_export", args=(self.report.pk, "everything"))
+        ).status_code, 404)
+
+
+class ImportTripsTest(TripsTestCase):
+
+    def import_trips(self, content, *args):
+        with NamedTemporaryFile("w", suffix=".csv") as f:
+            f.write(content)
+            f.flush()
+            out = StringIO()
+            call_command("import_trips", f.name, *args, stdout=out, stderr=out)
+        return out.getvalue()
+
+    def test_import(self):
+        out = self.import_trips(
+            "date,way,driver,passengers,notes\n"
+            "2020-04-01,go_to,ana,beto caro,\n"
+            "2020-04-01,return,ana,\"beto,caro,dani\",Lluvia\n"
+            "2020-03-03,go_to,beto,caro,\n"  # Joins an existing trip
+        )
+
+        self.assertIn("3 trips with 9 passengers imported", out)
+        trip = Trip.objects.get(car=self.car_a, date=date(2020, 4, 1), way=Trip.RETURN)
+        self.assertEqual(trip.notes, "Lluvia")
+        self.assertEqual(trip.passenger_count, 3)
+        self.assertEqual(trip.price_per_passenger, Decimal("75"))
+        existing = Trip.objects.get(car=self.car_b)
+        self.assertEqual(existing.participant_ids, [self.ana.pk, self.caro.pk, self.dani.pk])
+        self.assertEqual(existing.price_per_passenger, Decimal("50"))
+        self.assertEqual(Balance.objects.totals(), Balance.objects.computed())
+
+    def test_import_more_trips_than_a_sqlite_insert_takes(self):
+        rows = "".join(
+            f"{date(2021, 1, 1) + timedelta(days=day)},{way},ana,beto caro\n"
+            for day in range(300) for way in Trip.TRIP_WAYS
+        )
+        out = self.import_trips("date,way,driver,passengers\n" + rows)
+
+        self.assertIn("600 trips with 1800 passengers imported", out)
+        self.assertEqual(Trip.objects.filter(date__year=2021, passenger_count=2).count(), 600)
+        self.assertEqual(Balance.objects.totals(), Balance.objects.computed())
+
+    def test_invalid_rows_import_nothing(self):
+        content = (
+            "date,way,driver,passengers\n"
+            "2020-04-01,go_to,ana,beto\n"
+            "2020-04-31,go_to,ana,beto\n"
+            "2020-04-02,go_to,nadie,beto\n"
+            "2020-04-02,go_to,beto,nobody\n"
+        )
+        with self.assertRaisesMessage(CommandError, "3 invalid rows"):
+            self.import_trips(content, "--chunk-size", "2")
+        self.assertEqual(Trip.objects.count(), 5)
+
+    def test_dry_run(self):
+        out = self.import_trips("date,way,driver,passengers\n2020-04-01,go_to,ana,beto\n",
+                                "--dry-run")
+
+        self.assertIn("1 trips with 2 passengers are valid", out)
+        self.assertEqual(Trip.objects.count(), 5)
+
+    def test_jsonl(self):
+        with NamedTemporaryFile("w", suffix=".jsonl") as f:
+            f.write('{"date": "2020-04-01", "driver": "caro", "passengers": ["ana", "beto"]}\n')
+            f.flush()
+            call_command("import_trips", f.name, stdout=StringIO())
+
+        trip = Trip.objects.get(date=date(2020, 4, 1))
+        self.assertEqual((trip.car, trip.way, trip.passenger_count), (self.car_c, Trip.GOTO, 2))
+
+
+class ScheduleTest(TripsTestCase):
+
+    def setUp(self):
+        self.weekdays = Schedule.objects.create(car=self.car_a, since=date(2020, 1, 1))
+        self.weekdays.passengers.add(self.beto, self.dani)
+        self.returns = Schedule.objects.create(car=self.car_b, way=Trip.RETURN, weekdays="24",
+                                               since=date(2020, 1, 1), until=date(2020, 3, 31))
+        self.returns.passengers.add(self.ana)
+
+    def test_materialize(self):
+        created = Schedule.objects.materialize(date(2020, 3, 2), date(2020, 3, 8))
+
+        self.assertEqual(created, 6)  # Mon 2 exists: Tue to Fri, and returns Wed 4 and Fri 6
+        trip = Trip.objects.get(car=self.car_a, date=date(2020, 3, 3))
+        self.assertEqual(set(trip.passengers.all()), {self.ana, self.beto, self.dani})
+        self.assertEqual((trip.price_per_passenger, trip.passenger_count), (Decimal("100"), 2))
+        returns = Trip.objects.filter(car=self.car_b, way=Trip.RETURN)
+        self.assertEqual(list(returns.values_list("date", flat=True)),
+                         [date(2020, 3, 4), date(2020, 3, 6)])
+        self.assertEqual(Trip.objects.get(car=self.car_a, date=date(2020, 3, 2),
+                                          way=Trip.GOTO).passenger_count, 2)  # Unchanged
+        self.assertEqual(Balance.objects.totals(), Balance.objects.computed())
+        self.assertEqual(Schedule.objects.materialize(date(2020, 3, 2), date(2020, 3, 8)), 0)
+
+    def test_query_count_does_not_grow_with_days(self):
+        # Schedules, passengers, existing trips, insert, new trips, insert passengers, prices,
+        # ledger balances & update, savepoints
+        with self.assertNumQueries(12):
+            Schedule.objects.materialize(date(2020, 4, 1), date(2020, 4, 7))
+        with self.assertNumQueries(12):
+            Schedule.objects.materialize(date(2020, 4, 8), date(2020, 6, 30))
+        self.assertFalse(Trip.objects.filter(car=self.car_b, date__gt=date(2020, 3, 31)))
+
+    def test_command(self):
+        out = StringIO()
+        call_command("materialize_schedules", "--since", "2020-03-09", "--until", "2020-03-15",
+                     "--car", str(self.car_b.pk), stdout=out)
+
+        self.assertIn("2 trips created (2020-03-09 to 2020-03-15)", out.getvalue())
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class TripAdminTest(TripsTestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser("admin", "admin@example.com", "secret")
+        self.client.force_login(self.admin)
+
+    def test_changelist_query_count_does_not_depend_on_page_size(self):
+        report = Report.objects.create(creator=self.ana)
+        Trip.objects.filter(car=self.car_a).update(report=report)
+        url = reverse("myadmin:trips_trip_changelist")
+        with self.assertNumQueries(9):
+            self.client.get(url)
+
+        for day in range(1, 29):
+            self.make_trip(self.car_b, date(2020, 2, day), Trip.GOTO, self.ana, self.caro)
+        with self.assertNumQueries(9):
+            response = self.client.get(url)
+        self.assertEqual(len(response.context["cl"].result_list), 33)
+
+    def test_report_changelist_query_count_does_not_depend_on_reports(self):
+        url = reverse("myadmin:trips_report_changelist")
+        for car in (self.car_a, self.car_b):
+            report = Report.objects.create(creator=self.ana)
+            Trip.objects.filter(car=car).update(report=report)
+        # Session, user, 2 counts, reports (with their people IDs), people names
+        with self.assertNumQueries(6):
+            self.client.get(url)
+
+        report = Report.objects.create(creator=self.beto)
+        Trip.objects.filter(car=self.car_c).update(report=report)
+        Report.objects.create(creator=self.beto)  # Without trips
+        with self.assertNumQueries(6):
+            response = self.client.get(url)
+        self.assertContains(response, "March 4, 2020")
+        self.assertContains(response, "Ana, Beto, Caro, Dani")  # Car C trips: Caro drives alone
+
+    def test_report_people_names_with_commas(self):
+        User.objects.filter(pk=self.caro.pk).update(first_name="Caro, la del auto")
+        report = Report.objects.create(creator=self.ana)
+        Trip.objects.filter(car=self.car_c).update(report=report)
+
+        response = self.client.get(reverse("myadmin:trips_report_changelist"))
+
+        self.assertEqual(response.context["cl"].result_list[0].people_names,
+                         ["Ana", "Beto", "Caro, la del auto", "Dani"])
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class RegistrationTest(TripsTestCase):
+
+    def setUp(self):
+        self.client.force_login(self.dani)
+
+    def test_confirm_posts_to_one_tap_registration(self):
+        response = self.client.get(reverse("trips:confirm", args=["beto"]))
+
+        self.assertEqual(response.context["processing_url"],
+                         reverse("trips:register_now", args=["beto"]))
+        self.assertEqual(self.client.get(reverse("trips:confirm", args=["nadie"])).status_code, 404)
+
+    def test_register_now(self):
+        url = reverse("trips:register_now", args=["beto"])
+        self.client.post(url)  # Creates the trip
+        trip = Trip.objects.get(car=self.car_b, date=date.today())
+        self.client.force_login(self.caro)
+
+        # Session, user, car (not cached, see Car.objects.ids_for_username()), savepoint, get trip,
+        # existing passengers, insert, price aggregate & update, ledger balances & update, release
+        # savepoint: 12 on every scan
+        with self.assertNumQueries(12):
+            response = self.client.post(url)
+
+        self.assertRedirects(response, "/admin/trips/trip/", fetch_redirect_response=False)
+        self.assertEqual(set(trip.passengers.all()), {self.beto, self.caro, self.dani})
+        self.assertEqual(Trip.objects.get(pk=trip.pk).price_per_passenger, Decimal("66.67"))
+
+    def test_car_lookup_is_a_single_query(self):
+        with self.assertNumQueries(1):
+            ids = Car.objects.ids_for_username("beto")
+        self.assertEqual(ids, (self.car_b.pk, self.beto.pk, self.car_b.group_id))
+
+    def test_register_to_a_deleted_car(self):
+        url = reverse("trips:register_now", args=["beto"])
+        self.client.post(url)
+        Car.objects.filter(owner=self.beto).delete()
+
+        self.assertEqual(self.client.post(url).status_code, 404)
+
+
+class ConcurrentRegistrationTest(TransactionTestCase):
+    """Passengers scanning the same QR code at once. Runs against the configured DB (SQLite or
+    PostgreSQL, see DATABASE_URL), but not on an in-memory SQLite test DB: set
+    TEST_DATABASE_NAME to a file."""
+
+    N = 8
+
+    def setUp(self):
+        if connection.vendor == "sqlite" and connection.is_in_memory_db():
+            self.skipTest("The in-memory SQLite DB doesn't wait for locks")
+        self.driver = User.objects.create(username="driver")
+        self.car = Car.objects.create(owner=self.driver, price_per_trip=Decimal("90"))
+        self.passengers = [User.objects.create(username=f"p{i}") for i in range(self.N)]
+
+    def run_in_threads(self, register):
+        barrier, errors = Barrier(self.N), []
+
+        def target(user):
+            try:
+                barrier.wait()
+                register(user)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()  # Each thread has its own connection
+
+        threads = [Thread(target=target, args=(user,)) for user in self.passengers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def assertSingleTrip(self):
+        trip = Trip.objects.get()
+        self.assertEqual(set(trip.passengers.all()), {self.driver, *self.passengers})
+        self.assertEqual(trip.price_per_passenger, Decimal("10"))
+        self.assertEqual(Balance.objects.totals(), Balance.objects.computed())
+
+    def test_simultaneous_register_passenger(self):
+        self.run_in_threads(lambda user: Trip.objects.register_passenger(
+            user, self.car.pk, self.driver.pk, date(2020, 3, 2), Trip.GOTO
+        ))
+        self.assertSingleTrip()
+
+    def test_simultaneous_register_new_trip(self):
+        data = {"date": "2020-03-02", "car": self.car.pk, "way": Trip.GOTO}
+
+        def register(user):
+            client = self.client_class()
+            client.force_login(user)
+            response = client.post(reverse("trips:register_new"), data)
+            self.assertEqual(response.status_code, 302)
+
+        self.run_in_threads(register)
+        self.assertSingleTrip()
+
+
+class FareStubHandler(BaseHTTPRequestHandler):
+    """The fares site: /<route>/<date> pages with a price per bus, but for the 13th (an error)."""
+
+    def do_GET(self):
+        day = date.fromisoformat(self.path.rsplit("/", 1)[1])
+        if day.day == 13:
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.end_headers()
+        self.wfile.write(
+            f"""<div class="bus"><div title="Precio"> $ 1.{day.day:03},50 </div></div>
+            <div class="bus"><div title="Precio"><span>$</span> 900,00</div></div>""".encode()
+        )
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class FaresTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FareStubHandler)
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}/{{route}}/{{date:%Y-%m-%d}}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        fares.fare_cache().clear()
+
+    def test_parse_fares(self):
+        self.assertEqual(
+            fares.parse_fares('<p title="Precio">$ 1.234,50</p><b title="Precio">99.5</b>'
+                              '<p title="Otro">7</p>'),
+            [Decimal("1234.50"), Decimal("99.5")],
+        )
+
+    def test_refresh_and_suggest(self):
+        self.assertIsNone(fares.suggested_price(since=date(2020, 3, 11)))
+        out = StringIO()
+        with override_settings(TRIPS_FARE_URL=self.url), self.assertLogs("trips.fares", "WARNING"):
+            call_command("refresh_fares", "--since", "2020-03-11", "--days", "3", stdout=out)
+
+        self.assertIn("Fares cached for 2 of 3 days.", out.getvalue())
+        self.assertEqual(fares.cached_fares(fares.next_days(date(2020, 3, 11), 3)), {
+            date(2020, 3, 11): Decimal("1011.50"), date(2020, 3, 12): Decimal("1012.50"),
+        })
+        self.assertEqual(fares.suggested_price(since=date(2020, 3, 11)), Decimal("2025.00"))
+
+    def test_car_admin_suggests_from_the_cache(self):
+        car = Car.objects.create(owner=User.objects.create(username="ana"))
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "x"))
+        url = reverse("myadmin:trips_car_change", args=(car.pk,))
+        self.assertContains(self.client.get(url), "manage.py refresh_fares")
+
+        fares.refresh_fares([date.today() + timedelta(days=1)], fetcher=self.fetch)
+        self.assertContains(self.client.get(url), "1800.00")
+
+    @staticmethod
+    async def fetch(route, day):
+        return [Decimal("900.00"), Decimal("850.00")]
+
+
+class BenchmarkCommandsTest(TestCase):
+
+    def test_seed_carpool(self):
+        out = StringIO()
+        call_command("seed_carpool", "--users", "10", "--cars", "2", "--days", "3", stdout=out)
+
+        self.assertIn("Created 10 users, 2 cars, 12 trips", out.getvalue())
+        call_command("check_trip_membership", stdout=out)  # Prices and passengers are set
+
+    def test_benchmark_payments(self):
+        out = StringIO()
+        call_command("benchmark_payments", "--edges", "200", stdout=out)
+
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(results[0]["stage"], "analyze_trips")
+        self.assertEqual(results[0]["queries"], 1)
+        self.assertEqual(results[-1]["stage"], "prepare_report_data")
+        self.assertFalse(Trip.objects.exists())  # Rolled back
+
+    def test_explain_trip_queries(self):
+        out = StringIO()
+        call_command("explain_trip_queries", "--seed-days", "3", "--repeat", "1", stdout=out)
+
+        self.assertIn("Without the indexes", out.getvalue())
+        self.assertFalse(Trip.objects.exists())  # Rolled back, the indexes too
+        with connection.cursor() as cursor:
+            indexes = connection.introspection.get_constraints(cursor, Trip._meta.db_table)
+        self.assertTrue({index.name for index in Trip._meta.indexes} <= set(indexes))
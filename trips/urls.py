@@ -1,7 +1,8 @@
 from django.contrib.auth.decorators import login_required
 from django.urls import path
 from trips.views import (TripRegistrationConfirmation, RegisterNewTrip, RegisterInExistingTrip,
-                         ReportPayments)
+                         RegisterRidingWith, ReportPayments, ReportExport, CurrentBalances,
+                         CurrentUserBalance)
 
 app_name = 'trips'
 urlpatterns = [
@@ -10,6 +11,11 @@ urlpatterns = [
         login_required(TripRegistrationConfirmation.as_view()),
         name="confirm",
     ),
+    path(
+        'register/riding_with/<str:username>/now/',
+        login_required(RegisterRidingWith.as_view()),
+        name="register_now",
+    ),
     path(
         'register/new/',
         login_required(RegisterNewTrip.as_view()),
@@ -26,4 +32,20 @@ urlpatterns = [
         login_required(ReportPayments.as_view()),
         name="report_payments",
     ),
+    path(
+        'report/<int:pk>/export/<str:kind>/',
+        login_required(ReportExport.as_view()),
+        name="report_export",
+    ),
+
+    path(
+        'balances/',
+        login_required(CurrentBalances.as_view()),
+        name="current_balances",
+    ),
+    path(
+        'balances/<str:username>/',
+        login_required(CurrentUserBalance.as_view()),
+        name="current_user_balance",
+    ),
 ]
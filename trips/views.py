@@ -1,14 +1,21 @@
 from django.contrib.auth import get_user_model
 from django.forms import ModelForm
-from django.http import HttpResponseRedirect
-from trips.models import Trip, Report
+from django.http import Http404, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from trips.exports import EXPORTS, FORMATS, export_report
+from trips.models import (
+    Balance, Car, Trip, Report, carpool_groups, group_filter, in_carpool_group
+)
+from trips.payments import DEFAULT_SETTLEMENT, SETTLEMENT_STRATEGIES, from_cents
 from django.urls import reverse
 from django.utils.timezone import datetime
-from django.views.generic import DetailView, TemplateView, CreateView, UpdateView
+from django.views.generic import DetailView, TemplateView, CreateView, UpdateView, View
 from django.views.generic.edit import ModelFormMixin
 
 
+REPORT_POLL_SECONDS = 2
+
+
 class TripForm(ModelForm):
     class Meta:
         model = Trip
@@ -21,6 +28,44 @@ class TripForm(ModelForm):
             self.fields[name].widget.attrs['style'] = "pointer-events: none;"  # Hack de vago
 
 
+def current_date_and_way():
+    d = datetime.now()
+    # GOTO if it's before noon. RETURN otherwise.
+    way = d.hour <= 12 and Trip.GOTO or Trip.RETURN
+    return d.date(), way
+
+
+def get_car_ids_or_404(username, user):
+    """(car ID, owner ID) of the car of `username`, if it's in a carpool group of the user."""
+    try:
+        car_id, owner_id, group_id = Car.objects.ids_for_username(username)
+    except Car.DoesNotExist:
+        raise Http404(f"{username} has no car")
+    if not in_carpool_group(user, group_id):
+        raise Http404(f"{username} has no car in your groups")
+    return car_id, owner_id
+
+
+def get_group_id_or_404(request):
+    """The carpool group of the request (?group=ID): by default, the only group of the user.
+
+    None (the trips without a group) for the users without groups, and the superusers.
+    """
+    group_id = request.GET.get("group")
+    if group_id is None:
+        groups = carpool_groups(request.user)
+        if groups and len(groups) > 1:
+            raise Http404("Choose one of your groups with ?group=ID")
+        return groups[0] if groups else None
+    try:
+        group_id = int(group_id)
+    except ValueError:
+        raise Http404(f"Invalid group {group_id}")
+    if not in_carpool_group(request.user, group_id):
+        raise Http404(f"You are not in the group {group_id}")
+    return group_id
+
+
 class TripRegistrationConfirmation(TemplateView, ModelFormMixin):
     http_method_names = ['get']
     template_name = "trips/confirm_trip.html"
@@ -28,44 +73,53 @@ class TripRegistrationConfirmation(TemplateView, ModelFormMixin):
     model = Trip
 
     def get_context_data(self, **kwargs):
-
-        car_owner = get_object_or_404(get_user_model(), username=kwargs["username"])
-        d = datetime.now()
-        # GOTO if it's before noon. RETURN otherwise.
-        way = d.hour <= 12 and Trip.GOTO or Trip.RETURN
-
-        trip_params = {
-            "date": d.date(),
-            "car": car_owner.cars.get(),
-            "way": way
-        }
-        try:
-            # The Trip already exists
-            trip = Trip.objects.get(**trip_params)
-        except Trip.DoesNotExist:
-            #  A new Trip instance
-            trip = Trip(**trip_params)
-        self.object = trip
+        car_id, _ = get_car_ids_or_404(kwargs["username"], self.request.user)
+        date, way = current_date_and_way()
+        # Just for display: RegisterRidingWith finds (or creates) the actual trip
+        self.object = Trip(date=date, car_id=car_id, way=way)
 
         context = super().get_context_data(**kwargs)
-        register_existing = trip.id and reverse("trips:register_existing", args=[trip.id])
-        register_new = reverse("trips:register_new")
-        context["processing_url"] = register_existing or register_new
+        context["processing_url"] = reverse("trips:register_now", args=[kwargs["username"]])
         return context
 
 
+class RegisterRidingWith(View):
+    """One tap registration: the user is riding now in the car of `username`."""
+    http_method_names = ['post']
+    success_url = "/admin/trips/trip/"
+
+    def post(self, request, username):
+        car_id, owner_id = get_car_ids_or_404(username, request.user)
+        date, way = current_date_and_way()
+        Trip.objects.register_passenger(request.user, car_id, owner_id, date, way)
+        return HttpResponseRedirect(self.success_url)
+
+
+class RegistrationForm(TripForm):
+
+    def validate_unique(self):
+        """The trip may already exist (someone registered first): join it, don't fail."""
+
+
 class RegisterNewTrip(CreateView):
     http_method_names = ['post']
-    form_class = TripForm
+    form_class = RegistrationForm
     model = Trip
     success_url = "/admin/trips/trip/"
 
+    def get_form(self, form_class=None):
+        form = super().get_form(form_class)
+        form.fields["car"].queryset = Car.objects.filter(group_filter(self.request.user))
+        return form
+
     def form_valid(self, form):
-        """If the form is valid, save the associated model."""
-        response = super().form_valid(form)  # This step saves the Trip instance
-        trip = self.object
-        trip.passengers.add(self.request.user, trip.car.owner)
-        return response
+        """Register in the trip. If someone else created it meanwhile, join that one."""
+        car = form.cleaned_data["car"]
+        self.object, _ = Trip.objects.register_passenger(
+            self.request.user, car.pk, car.owner_id, form.cleaned_data["date"],
+            form.cleaned_data["way"],
+        )
+        return HttpResponseRedirect(self.get_success_url())
 
 
 class RegisterInExistingTrip(UpdateView):
@@ -74,19 +128,120 @@ class RegisterInExistingTrip(UpdateView):
     model = Trip
     success_url = "/admin/trips/trip/"
 
+    def get_queryset(self):
+        return Trip.objects.filter(group_filter(self.request.user, "car__group"))
+
     def form_valid(self, form):
         """If the form is valid, don't save the Trip instance, just add a passenger."""
         trip = self.object
-        trip.passengers.add(self.request.user, trip.car.owner)
+        Trip.objects.register_passenger(
+            self.request.user, trip.car_id, trip.car.owner_id, trip.date, trip.way
+        )
         return HttpResponseRedirect(self.get_success_url())
 
 
 class ReportPayments(DetailView):
+    """The payments of a report. While they are computed in the background (see Report.status),
+    a page that reloads itself every REPORT_POLL_SECONDS."""
     http_method_names = ['get']
     template_name = "trips/report.html"
     model = Report
 
+    def get_queryset(self):
+        return Report.objects.filter(group_filter(self.request.user))
+
+    def get_template_names(self):
+        if not self.object.is_ready:
+            return ["trips/report_pending.html"]
+        return super().get_template_names()
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context.update(self.object.payments_report)
+        if not self.object.is_ready:
+            context["poll_seconds"] = REPORT_POLL_SECONDS
+            return context
+        strategy = self.request.GET.get("strategy")
+        if strategy not in SETTLEMENT_STRATEGIES:
+            strategy = DEFAULT_SETTLEMENT
+        context.update(self.object.get_payments_report(strategy=strategy))
+        context["exports"] = EXPORTS
         return context
+
+
+class ReportExport(DetailView):
+    """The details, totals or transfers of a report, as CSV (or JSON, with ?format=json).
+
+    Streamed from the DB, whatever the size of the report.
+    """
+    http_method_names = ['get']
+    model = Report
+
+    def get_queryset(self):
+        return Report.objects.filter(group_filter(self.request.user))
+
+    def get(self, request, *args, kind, **kwargs):
+        fmt = request.GET.get("format", "csv")
+        if kind not in EXPORTS or fmt not in FORMATS:
+            raise Http404(f"No {fmt} export of the report {kind}")
+        report = self.get_object()
+        response = StreamingHttpResponse(
+            export_report(report, kind, fmt), content_type=FORMATS[fmt][1]
+        )
+        response["Content-Disposition"] = (
+            f'attachment; filename="report-{report.pk}-{kind}.{fmt}"'
+        )
+        return response
+
+
+def balance_json(uid, current):
+    collect, pay = current["balances"].get(uid, (0, 0))
+    username, name = current["people"].get(uid, (None, None))
+    return {
+        "username": username,
+        "name": name,
+        "collects": from_cents(collect),
+        "pays": from_cents(pay),
+        "balance": from_cents(collect - pay),
+    }
+
+
+class CurrentBalances(View):
+    """JSON with the running balances of everyone in a carpool group (see get_group_id_or_404()),
+    for the trips not reported yet.
+
+    The payments are the ones a report of all the un-reported trips of the group would have.
+    """
+    http_method_names = ['get']
+
+    def get(self, request):
+        current = Balance.objects.current_payments(get_group_id_or_404(request))
+        people = current["people"]
+        return JsonResponse({
+            "balances": [balance_json(uid, current) for uid in current["balances"]],
+            "payments": [
+                {"from": people[payer][0], "to": people[collector][0], "ammount": from_cents(cents)}
+                for payer, collector, cents in current["transfers"]
+            ],
+        })
+
+
+class CurrentUserBalance(View):
+    """JSON with the running balance of a user in a carpool group (see get_group_id_or_404()):
+    how much they owe (or are owed) right now."""
+    http_method_names = ['get']
+
+    def get(self, request, username):
+        user = get_object_or_404(get_user_model(), username=username)
+        current = Balance.objects.current_payments(get_group_id_or_404(request))
+        people = current["people"]
+        data = balance_json(user.pk, current)
+        data.update(username=user.username, name=user.get_full_name())
+        data["pays_to"] = [
+            {"username": people[collector][0], "ammount": from_cents(cents)}
+            for payer, collector, cents in current["transfers"] if payer == user.pk
+        ]
+        data["collects_from"] = [
+            {"username": people[payer][0], "ammount": from_cents(cents)}
+            for payer, collector, cents in current["transfers"] if collector == user.pk
+        ]
+        return JsonResponse(data)